@@ -1,91 +1,144 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
-from pymongo import MongoClient
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, InlineQueryHandler, MessageHandler, filters, ConversationHandler
 from datetime import datetime
-import requests
+import argparse
+import asyncio
+import os
+import re
+from google_books import ClienteGoogleBooks, ErrorGoogleBooks, libro_desde_item
+from cache import CacheBusquedas, CachePortadas, CacheVolumenes
+from repositorio import TAMANO_PAGINA, RepositorioMongo
+from envios import LimitadorEnvios
+from persistencia import PersistenciaMongo
+from planificador import ProcesadorPorUsuario
+from metricas import Metricas
+from importacion import Importador
+from busqueda_inline import BusquedaInline
+from escritura_diferida import EscrituraDiferida
+from recomendaciones import Recomendador
+from callbacks import Despachador, codificar, patron
+
+
+AVISO_SIN_GOOGLE = "⚠️ Google Books no responde en este momento. Inténtalo de nuevo en unos minutos."
+AVISO_DATOS_GUARDADOS = "⚠️ Google Books no responde: te mostramos datos guardados, puede que no estén al día."
 
 class CapituloCeroBot:
-    def __init__(self, token):
+    def __init__(self, token, repositorio=None, google_books=None):
         try: 
-            self.client = MongoClient('mongodb://localhost:27017/')
-            self.db = self.client.biblioteca_db
+            self.repositorio = repositorio or RepositorioMongo()
             self.token = token   
             
         except Exception as e:
             print(f"Error al conectar a MongoDB: {e}")
             exit()   
 
-        self.usuarios = self.db.usuarios
-        self.biblioteca_personal = self.db.biblioteca_personal
-        self.lista_lectura = self.db.lista_lectura
-        
-        self.GOOGLE_BOOKS_URL = "https://www.googleapis.com/books/v1/volumes"
-        
-    async def buscar_libro_google(self, query):
-        params = {
-            'q': query,
-            'maxResults': 3, 
-            'langRestrict': 'es' 
-        }
+        self.google_books = google_books or ClienteGoogleBooks()
+        self.volumenes = CacheVolumenes(self.repositorio.volumenes)
+        self.busquedas = CacheBusquedas()
+        self.portadas = CachePortadas(self.repositorio.portadas)
+        self.importador = Importador(self)
+        self.inline = BusquedaInline(self)
+        self.escrituras = EscrituraDiferida(self.repositorio)
+        self.recomendador = Recomendador(self.repositorio)
+        self.metricas = Metricas()
+        self.metricas.registrar_indicador(
+            'capitulo_cache_busquedas', 'Aciertos, fallos y busquedas compartidas de la cache de Google Books.',
+            self.busquedas.metricas, contadores=('aciertos', 'fallos', 'compartidas', 'caducadas')
+        )
+        self.metricas.registrar_indicador(
+            'capitulo_escrituras_pendientes', 'Escrituras diferidas aun no volcadas a MongoDB.',
+            self.escrituras.metricas
+        )
+        self.metricas.registrar_indicador(
+            'capitulo_google_books', 'Circuito, reintentos, peticiones rechazadas y cuota restante de Google Books.',
+            self.google_books.metricas,
+            contadores=('aperturas', 'reintentos', 'rechazadas_circuito', 'rechazadas_cuota')
+        )
+        self.metricas.registrar_indicador(
+            'capitulo_cache_volumenes', 'Volumenes guardados en memoria.', lambda: len(self.volumenes.memoria)
+        )
+
+    async def inicializar(self, application=None):
+        indices = await self.repositorio.asegurar_indices()
+        for coleccion, nombres in indices.items():
+            print(f"Índices en {coleccion}: {', '.join(nombres)}")
+        await self.metricas.iniciar_servidor()
+        self.recomendador.iniciar()
+
+    async def cerrar(self, application=None):
+        self.metricas.cerrar()
+        await self.recomendador.cerrar()
+        await self.escrituras.cerrar()
+        await self.google_books.cerrar()
+        self.repositorio.cerrar()
         
+    async def buscar_libro_google(self, query, max_resultados=3):
+        # Devuelve (libros, aviso); aviso solo se rellena si Google esta fallando
         try:
-            response = requests.get(self.GOOGLE_BOOKS_URL, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if 'items' not in data:
-                return []
-                
-            libros = []
-            for item in data['items']:
-                info = item['volumeInfo']
-                libro = {
-                    'titulo': info.get('title', 'Sin título'),
-                    'autor': ', '.join(info.get('authors', ['Autor desconocido'])),
-                    'descripcion': info.get('description', 'Sin descripción'),
-                    'categorias': info.get('categories', []),
-                    'imagen': info.get('imageLinks', {}).get('thumbnail', None),
-                    'id_google': item['id'],
-                    'fecha_publicacion': info.get('publishedDate', 'Fecha desconocida'),
-                    'isbn': next((id['identifier'] for id in info.get('industryIdentifiers', []) 
-                                if id['type'] == 'ISBN_13'), None)
-                }
-                libros.append(libro)
-            return libros
-        except requests.RequestException as e:
+            items, caducado = await self.busquedas.obtener(
+                query, self._buscar_en_google, max_resultados=max_resultados, idioma='es'
+            )
+        except ErrorGoogleBooks as e:
             print(f"Error al buscar en Google Books: {e}")
-            return []
-
-    def get_libro_detalles(self, libro_id):
-        url = f"https://www.googleapis.com/books/v1/volumes/{libro_id}"
-        response = requests.get(url)
-        if response.status_code == 200:
-            libro = response.json()
-            detalles = {
-                'titulo': libro.get('volumeInfo', {}).get('title', 'Sin título'),
-                'autor': ', '.join(libro.get('volumeInfo', {}).get('authors', ['Sin autor'])),
-                'anio': libro.get('volumeInfo', {}).get('publishedDate', 'Sin año'),
-                'descripcion': libro.get('volumeInfo', {}).get('description', 'Sin descripción disponible')
-            }
-            return detalles
-        else:
-            return None     
+            return [], AVISO_SIN_GOOGLE
+        aviso = AVISO_DATOS_GUARDADOS if caducado and not self.google_books.disponible() else None
+        return [libro_desde_item(item) for item in items], aviso
+
+    async def _buscar_en_google(self, query, **params):
+        items = await self.google_books.buscar(query, **params)
+        # Los resultados ya traen el volumeInfo completo: se guardan para que
+        # agregar y ver detalles no tengan que pedirlo otra vez a Google.
+        await self.volumenes.guardar_varios({item['id']: item.get('volumeInfo', {}) for item in items})
+        return items
+
+    async def obtener_info_volumen(self, libro_id):
+        return (await self._obtener_info_volumen(libro_id))[0]
+
+    async def _obtener_info_volumen(self, libro_id):
+        # Devuelve (volumeInfo, caducado). Si Google falla se usa la copia
+        # guardada aunque haya caducado; sin copia se propaga el error.
+        info = await self.volumenes.obtener(libro_id)
+        if info is not None:
+            return info, False
+        try:
+            libro = await self.google_books.obtener_volumen(libro_id)
+        except ErrorGoogleBooks:
+            info = await self.volumenes.obtener(libro_id, caducado=True)
+            if info is None:
+                raise
+            return info, True
+        info = libro.get('volumeInfo', {})
+        await self.volumenes.guardar(libro_id, info)
+        return info, False
+
+    async def get_libro_detalles(self, libro_id):
+        try:
+            info, caducado = await self._obtener_info_volumen(libro_id)
+        except ErrorGoogleBooks as e:
+            print(f"Error al obtener los detalles de {libro_id}: {e}")
+            return None
+        detalles = {
+            'titulo': info.get('title', 'Sin título'),
+            'autor': ', '.join(info.get('authors', ['Sin autor'])),
+            'anio': info.get('publishedDate', 'Sin año'),
+            'descripcion': info.get('description', 'Sin descripción disponible'),
+            'aviso': AVISO_DATOS_GUARDADOS if caducado else None
+        }
+        return detalles
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
 
-        if not self.usuarios.find_one({"user_id": user_id}):
-            self.usuarios.insert_one({
-                "user_id": user_id,
-                "username": update.effective_user.username,
-                "created_at": datetime.now()
-            })
+        self.escrituras.registrar_usuario(user_id, update.effective_user.username)
 
         keyboard = [
-            [InlineKeyboardButton("📚 Buscar Libro", callback_data='buscar_libro')],
-            [InlineKeyboardButton("📖 Mi Biblioteca", callback_data='mi_biblioteca')],
-            [InlineKeyboardButton("📝 Lista de Lectura", callback_data='lista_lectura')],
-            [InlineKeyboardButton("📊 Mis Estadísticas", callback_data='estadisticas')]
+            [InlineKeyboardButton("📚 Buscar Libro", callback_data=codificar('buscar_libro'))],
+            [InlineKeyboardButton("📖 Mi Biblioteca", callback_data=codificar('mi_biblioteca'))],
+            [InlineKeyboardButton("📝 Lista de Lectura", callback_data=codificar('lista_lectura'))],
+            [InlineKeyboardButton("🔎 Buscar en mis libros", callback_data=codificar('buscar_mis_libros'))],
+            [InlineKeyboardButton("✨ Recomendaciones", callback_data=codificar('recomendaciones'))],
+            [InlineKeyboardButton("📊 Mis Estadísticas", callback_data=codificar('estadisticas'))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -116,16 +169,22 @@ class CapituloCeroBot:
 
     async def procesar_busqueda(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.message.text
-        libros = await self.buscar_libro_google(query)
-        
+        libros, aviso = await self.buscar_libro_google(query)
+
+        if aviso:
+            await update.message.reply_text(aviso)
         if not libros:
+            if aviso:
+                return ConversationHandler.END
             await update.message.reply_text(
                 "😔 No encontramos libros que coincidan con tu búsqueda.\n"
                 "📌 Consejo: Prueba con otro título, autor o palabras clave.\n"
                 "¡No te rindas, seguro encuentras algo genial!"
             )
             return ConversationHandler.END
-            
+
+        await self._enviar_portadas(update, libros)
+
         for libro in libros:
             texto = (
                 f"📖 {libro['titulo']}\n"
@@ -137,36 +196,96 @@ class CapituloCeroBot:
             keyboard = [
                 [
                     InlineKeyboardButton("➕ Agregar a Biblioteca", 
-                                       callback_data=f"add_biblioteca_{libro['id_google']}"),
+                                       callback_data=codificar('add_biblioteca', libro['id_google'])),
                     InlineKeyboardButton("📝 Agregar a Lista de Lectura", 
-                                       callback_data=f"add_lista_{libro['id_google']}")
+                                       callback_data=codificar('add_lista', libro['id_google']))
                 ]
             ]
 
-            keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')])
+            keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))])
             reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(texto, reply_markup=reply_markup)
             
         return ConversationHandler.END
 
+    async def _enviar_portadas(self, update, libros):
+        # Todas las portadas de la busqueda van en un unico album. Las que ya se
+        # subieron antes se envian por file_id; el resto por URL, y se guarda
+        # el file_id que devuelve Telegram para la proxima vez.
+        con_portada = [
+            libro for libro in libros if libro['imagen'] and not self.portadas.fallida(libro['id_google'])
+        ]
+        if not con_portada:
+            return
+        conocidas = await self.portadas.obtener_varios([libro['id_google'] for libro in con_portada])
+        medios = [
+            InputMediaPhoto(conocidas.get(libro['id_google'], libro['imagen']), caption=libro['titulo'][:1024])
+            for libro in con_portada
+        ]
+
+        try:
+            if len(medios) == 1:
+                mensajes = [await update.message.reply_photo(medios[0].media, caption=medios[0].caption)]
+            else:
+                mensajes = await update.message.reply_media_group(medios)
+        except BadRequest as e:
+            # Telegram rechaza el album entero si falla una sola portada y no
+            # dice cual: se reenvian de una en una para saberlo
+            print(f"Error al enviar las portadas: {e}")
+            await self._enviar_portadas_sueltas(update, con_portada, conocidas)
+            return
+        except TelegramError as e:
+            # Sin portadas se siguen mostrando los resultados
+            print(f"Error al enviar las portadas: {e}")
+            return
+
+        nuevas = {
+            libro['id_google']: mensaje.photo[-1].file_id
+            for libro, mensaje in zip(con_portada, mensajes)
+            if mensaje.photo and libro['id_google'] not in conocidas
+        }
+        await self.portadas.guardar_varios(nuevas)
+
+    async def _enviar_portadas_sueltas(self, update, libros, conocidas):
+        # Cada portada se prueba primero por file_id y despues por URL. Un
+        # file_id rechazado se olvida; una URL rechazada se marca como fallida.
+        nuevas = {}
+        olvidadas = []
+        for libro in libros:
+            libro_id = libro['id_google']
+            fuentes = [conocidas[libro_id]] if libro_id in conocidas else []
+            fuentes.append(libro['imagen'])
+            for fuente in fuentes:
+                try:
+                    mensaje = await update.message.reply_photo(fuente, caption=libro['titulo'][:1024])
+                except BadRequest as e:
+                    if fuente == libro['imagen']:
+                        print(f"Telegram no pudo descargar la portada de {libro_id}: {e}")
+                        self.portadas.marcar_fallida(libro_id)
+                    else:
+                        olvidadas.append(libro_id)
+                    continue
+                except TelegramError as e:
+                    print(f"Error al enviar la portada de {libro_id}: {e}")
+                    break
+                if fuente == libro['imagen'] and mensaje.photo:
+                    nuevas[libro_id] = mensaje.photo[-1].file_id
+                break
+
+        if olvidadas:
+            await self.portadas.eliminar_varios(olvidadas)
+        await self.portadas.guardar_varios(nuevas)
+
     async def agregar_a_biblioteca(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         query = update.callback_query
         await query.answer()
-        libro_id = query.data.split('_')[2]
+        libro_id = context.args[0]
         user_id = update.effective_user.id
         
-        if self.biblioteca_personal.find_one({"user_id": user_id, "google_id": libro_id}):
-            await query.message.reply_text(
-            "📚 Este libro ya está en tu biblioteca. No es necesario agregarlo de nuevo."
-            )
-            return
-        
         try:
-            params = {'id': libro_id}
-            response = requests.get(f"{self.GOOGLE_BOOKS_URL}/{libro_id}")
-            libro_info = response.json()['volumeInfo']
-        except requests.RequestException:
+            libro_info = await self.obtener_info_volumen(libro_id)
+        except ErrorGoogleBooks:
             await query.message.reply_text("⚠️ Hubo un problema al obtener la información del libro.")
             return
 
@@ -176,10 +295,15 @@ class CapituloCeroBot:
             "google_id": libro_id,
             "titulo": libro_info.get('title'),
             "autor": ', '.join(libro_info.get('authors', [])),
+            "categorias": libro_info.get('categories', []),
             "fecha_agregado": datetime.now(),
         }
 
-        self.biblioteca_personal.insert_one(libro)
+        if not await self.repositorio.agregar_a_biblioteca(libro):
+            await query.message.reply_text(
+            "📚 Este libro ya está en tu biblioteca. No es necesario agregarlo de nuevo."
+            )
+            return
 
         texto = (
             f"🎉 ¡Genial! '{libro_info.get('title', 'Sin título')}' ahora forma parte de tu biblioteca.\n"
@@ -188,8 +312,8 @@ class CapituloCeroBot:
 
         botones = [
             [
-                InlineKeyboardButton("⭐ Clasificar este libro", callback_data=f"calificar_biblioteca_{libro_id}"),
-                InlineKeyboardButton("🔙 Volver al inicio", callback_data="start")
+                InlineKeyboardButton("⭐ Clasificar este libro", callback_data=codificar('calificar_biblioteca', libro_id)),
+                InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))
             ]
         ]
 
@@ -198,44 +322,139 @@ class CapituloCeroBot:
 
     async def mostrar_biblioteca(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        libros = list(self.biblioteca_personal.find({"user_id": user_id}))
+        pagina, despues, antes = self._leer_paginacion(update, context)
+        await self.escrituras.vaciar_usuario(user_id)
+        libros, anterior, siguiente = await self.repositorio.pagina_biblioteca(user_id, despues, antes)
 
         if not libros:
-            await update.callback_query.message.reply_text(
+            await self._responder(
+                update,
                 "Tu biblioteca está vacía. ¡Empieza a agregar libros!",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')]]
+                InlineKeyboardMarkup(
+                    [[InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))]]
                 )
             )         
             return
 
-        for libro in libros:
-            texto = (
-                f"📖 {libro['titulo']}\n"
-                f"✍️ {libro['autor']}\n"
-                f"📅 Agregado el: {libro['fecha_agregado'].strftime('%d-%m-%Y')}\n"
-                f"⭐ Calificación: {libro.get('rating', 'Sin calificar')}\n"
+        texto = f"📖 Mi Biblioteca (página {pagina + 1})\n\n"
+        keyboard = []
+        for numero, libro in enumerate(libros, start=1):
+            texto += (
+                f"{numero}. 📖 {libro['titulo']}\n"
+                f"    ✍️ {libro['autor']}\n"
+                f"    📅 Agregado el: {libro['fecha_agregado'].strftime('%d-%m-%Y')}\n"
+                f"    ⭐ Calificación: {libro.get('rating', 'Sin calificar')}\n\n"
             )
-        
-            keyboard = [
-                [
-                    InlineKeyboardButton("📖 Ver Detalles", callback_data=f"detalles_biblioteca_{libro['google_id']}"),
-                    InlineKeyboardButton("❌ Eliminar", callback_data=f"eliminar_biblioteca_{libro['google_id']}")
-                ],
-                [
-                InlineKeyboardButton("⭐ Calificar", callback_data=f"calificar_biblioteca_{libro['google_id']}")
-            ]
-            ]
+            keyboard.append([
+                InlineKeyboardButton(f"{numero}. 📖 Detalles", callback_data=codificar('detalles_biblioteca', libro['google_id'])),
+                InlineKeyboardButton(f"{numero}. ⭐ Calificar", callback_data=codificar('calificar_biblioteca', libro['google_id'])),
+                InlineKeyboardButton(f"{numero}. ❌", callback_data=codificar('eliminar_biblioteca', libro['google_id']))
+            ])
+
+        keyboard += self._botones_paginacion('pagina_biblioteca', pagina, libros, anterior, siguiente)
+        keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))])
+        await self._responder(update, texto, InlineKeyboardMarkup(keyboard))
+
+    async def buscar_mis_libros(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Con /buscar_mis_libros <texto> se busca directamente; si no, se pide el texto
+        if context.args:
+            context.user_data['busqueda_propia'] = ' '.join(context.args)
+            await self.mostrar_busqueda_propia(update, context)
+            return ConversationHandler.END
 
-            keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.callback_query.message.reply_text(texto, reply_markup=reply_markup)
-            
+        query = update.callback_query
+        if query:
+            await query.answer()
+        await update.effective_message.reply_text(
+            "🔎 Escribe parte del título o del autor del libro que buscas en tu biblioteca y tu lista de lectura:"
+        )
+        return 'esperando_busqueda_propia'
+
+    async def procesar_busqueda_propia(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        context.user_data['busqueda_propia'] = update.message.text
+        await self.mostrar_busqueda_propia(update, context)
+        return ConversationHandler.END
+
+    async def mostrar_busqueda_propia(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        busqueda = context.user_data.get('busqueda_propia')
+        query = update.callback_query
+        pagina = 0
+        if query and context.args:
+            pagina = context.args[0]
+
+        keyboard = [[InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))]]
+        if not busqueda:
+            await self._responder(update, "La búsqueda ha caducado. Vuelve a buscar desde el menú.", InlineKeyboardMarkup(keyboard))
+            return
+
+        libros = await self.repositorio.buscar_libros_propios(user_id, busqueda)
+        if not libros:
+            await self._responder(
+                update, f"😔 No tienes libros que coincidan con «{busqueda}».", InlineKeyboardMarkup(keyboard)
+            )
+            return
+
+        paginas = (len(libros) + TAMANO_PAGINA - 1) // TAMANO_PAGINA
+        pagina = min(pagina, paginas - 1)
+        inicio = pagina * TAMANO_PAGINA
+        texto = f"🔎 Tus libros con «{busqueda}» ({len(libros)}) — página {pagina + 1} de {paginas}:\n\n"
+        botones = []
+        for numero, libro in enumerate(libros[inicio:inicio + TAMANO_PAGINA], start=inicio + 1):
+            if libro['estante'] == 'biblioteca':
+                texto += f"{numero}. 📖 {libro['titulo']} — {libro['autor']} (Biblioteca)\n"
+                botones.append(InlineKeyboardButton(
+                    f"{numero}. 📖 Detalles", callback_data=codificar('detalles_biblioteca', libro['google_id'])
+                ))
+            else:
+                texto += f"{numero}. 📝 {libro['titulo']} — {libro['autor']} (Lista de lectura)\n"
+                botones.append(InlineKeyboardButton(
+                    f"{numero}. ✅ Leído", callback_data=codificar('marcar_leido', libro['google_id'])
+                ))
+
+        navegacion = []
+        if pagina > 0:
+            navegacion.append(InlineKeyboardButton("⬅️ Anterior", callback_data=codificar('pagina_mis_libros', pagina - 1)))
+        if pagina < paginas - 1:
+            navegacion.append(InlineKeyboardButton("Siguiente ➡️", callback_data=codificar('pagina_mis_libros', pagina + 1)))
+        keyboard = [botones[i:i + 2] for i in range(0, len(botones), 2)] + ([navegacion] if navegacion else []) + keyboard
+        await self._responder(update, texto, InlineKeyboardMarkup(keyboard))
+
+    def _leer_paginacion(self, update, context):
+        # Los botones de navegacion llevan (pagina, 'sig' | 'ant', ObjectId de referencia)
+        if not update.callback_query or not context.args:
+            return 0, None, None
+
+        pagina, direccion, referencia = context.args
+        if direccion == 'sig':
+            return pagina, referencia, None
+        return pagina, None, referencia
+
+    def _botones_paginacion(self, prefijo, pagina, libros, anterior, siguiente):
+        botones = []
+        if anterior:
+            botones.append(InlineKeyboardButton(
+                "⬅️ Anterior", callback_data=codificar(prefijo, pagina - 1, 'ant', libros[0]['_id'])
+            ))
+        if siguiente:
+            botones.append(InlineKeyboardButton(
+                "Siguiente ➡️", callback_data=codificar(prefijo, pagina + 1, 'sig', libros[-1]['_id'])
+            ))
+        return [botones] if botones else []
+
+    async def _responder(self, update, texto, reply_markup):
+        # Desde un boton se edita el mismo mensaje; desde un comando se responde
+        query = update.callback_query
+        if query:
+            await query.answer()
+            await query.message.edit_text(texto, reply_markup=reply_markup)
+        else:
+            await update.message.reply_text(texto, reply_markup=reply_markup)
 
     async def detalles_libro_biblioteca(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        libro_id = query.data.split('_')[2]
-        detalles = self.get_libro_detalles(libro_id)
+        libro_id = context.args[0]
+        detalles = await self.get_libro_detalles(libro_id)
 
         if detalles:
             mensaje = (
@@ -244,6 +463,8 @@ class CapituloCeroBot:
                 f"*Año de publicación:* {detalles['anio']}\n"
                 f"*Descripción:* {detalles['descripcion']}\n"
             )
+            if detalles['aviso']:
+                mensaje += f"\n{detalles['aviso']}"
         else:
             mensaje = "No se pudieron obtener los detalles del libro."
 
@@ -251,10 +472,11 @@ class CapituloCeroBot:
 
     async def eliminar_de_biblioteca(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        libro_id = query.data.split('_')[2]
+        libro_id = context.args[0]
         user_id = update.effective_user.id
 
-        self.biblioteca_personal.delete_one({"user_id": user_id, "google_id": libro_id})
+        await self.escrituras.vaciar_usuario(user_id)
+        await self.repositorio.eliminar_de_biblioteca(user_id, libro_id)
         await query.message.reply_text(
             "El libro ha sido eliminado de tu biblioteca. 🗑️\n"
             "¡Espero encuentres algo mejor para leer pronto! 📚"
@@ -262,14 +484,14 @@ class CapituloCeroBot:
 
     async def calificar_libro(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        libros = list(self.biblioteca_personal.find({"user_id": user_id}))
+        libros = await self.repositorio.libros_biblioteca(user_id)
 
         if not libros:
             await update.callback_query.message.reply_text("Tu biblioteca está vacía. Agrega algunos libros primero.")
             return
         
         keyboard = [
-            [InlineKeyboardButton(libro["titulo"], callback_data=f"rate_{libro['_id']}")]
+            [InlineKeyboardButton(libro["titulo"], callback_data=codificar('calificar_biblioteca', libro['google_id']))]
             for libro in libros
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -279,42 +501,50 @@ class CapituloCeroBot:
 
     async def solicitar_calificacion(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        libro_id = query.data.split('_')[2]
+        libro_id = context.args[0]
         context.user_data['libro_calificar'] = libro_id
 
         keyboard = [
-            [InlineKeyboardButton("1 ⭐", callback_data="calificacion_1"),
-            InlineKeyboardButton("2 ⭐⭐", callback_data="calificacion_2")],
-            [InlineKeyboardButton("3 ⭐⭐⭐", callback_data="calificacion_3"),
-            InlineKeyboardButton("4 ⭐⭐⭐⭐", callback_data="calificacion_4")],
-            [InlineKeyboardButton("5 ⭐⭐⭐⭐⭐", callback_data="calificacion_5"),
-            InlineKeyboardButton("6 ⭐⭐⭐⭐⭐⭐", callback_data="calificacion_6")],
-            [InlineKeyboardButton("7 ⭐⭐⭐⭐⭐⭐⭐", callback_data="calificacion_7"),
-            InlineKeyboardButton("8 ⭐⭐⭐⭐⭐⭐⭐⭐", callback_data="calificacion_8")],
-            [InlineKeyboardButton("9 ⭐⭐⭐⭐⭐⭐⭐⭐⭐", callback_data="calificacion_9"),
-            InlineKeyboardButton("10 ⭐⭐⭐⭐⭐⭐⭐⭐⭐⭐", callback_data="calificacion_10")]
+            [InlineKeyboardButton("1 ⭐", callback_data=codificar('calificacion', libro_id, 1)),
+            InlineKeyboardButton("2 ⭐⭐", callback_data=codificar('calificacion', libro_id, 2))],
+            [InlineKeyboardButton("3 ⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 3)),
+            InlineKeyboardButton("4 ⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 4))],
+            [InlineKeyboardButton("5 ⭐⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 5)),
+            InlineKeyboardButton("6 ⭐⭐⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 6))],
+            [InlineKeyboardButton("7 ⭐⭐⭐⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 7)),
+            InlineKeyboardButton("8 ⭐⭐⭐⭐⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 8))],
+            [InlineKeyboardButton("9 ⭐⭐⭐⭐⭐⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 9)),
+            InlineKeyboardButton("10 ⭐⭐⭐⭐⭐⭐⭐⭐⭐⭐", callback_data=codificar('calificacion', libro_id, 10))]
         ]
 
-        keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')])
+        keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))])
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.reply_text("Selecciona una calificación para este libro:", reply_markup=reply_markup)
 
     async def guardar_calificacion(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Los botones traen (google_id, calificacion); escrita como texto solo
+        # llega la calificacion del libro elegido en solicitar_calificacion.
         query = update.callback_query
-        calificacion = int(query.data.split('_')[1])
         user_id = update.effective_user.id
-        libro_id = context.user_data.get('libro_calificar')
-
-        if not libro_id:
-            await query.message.reply_text("No se pudo identificar el libro a calificar. Inténtalo nuevamente.")
+        if query:
+            await query.answer()
+            libro_id, calificacion = context.args
+        else:
+            texto = update.message.text.strip()
+            # isdigit() tambien acepta '²' y similares, que int() rechaza
+            if not re.fullmatch(r'\d{1,2}', texto):
+                return
+            libro_id = context.user_data.get('libro_calificar')
+            calificacion = int(texto)
+
+        if not libro_id or not 1 <= calificacion <= 10:
+            await update.effective_message.reply_text("No se pudo identificar el libro a calificar. Inténtalo nuevamente.")
             return
 
-        self.biblioteca_personal.update_one(
-            {"user_id": user_id, "google_id": libro_id},
-            {"$set": {"rating": calificacion}}
-        )
-        await query.message.reply_text(f"Gracias por calificar el libro con {calificacion} ⭐.")            
+        context.user_data.pop('libro_calificar', None)
+        self.escrituras.calificar(user_id, libro_id, calificacion)
+        await update.effective_message.reply_text(f"Gracias por calificar el libro con {calificacion} ⭐.")
 
 
     async def agregar_a_lista_lectura(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -322,21 +552,12 @@ class CapituloCeroBot:
         query = update.callback_query
         await query.answer()
 
-        libro_id = query.data.split('_')[2]
+        libro_id = context.args[0]
         user_id = update.effective_user.id
-        
-
-        if self.lista_lectura.find_one({"user_id": user_id, "google_id": libro_id}):
-            await query.message.reply_text(
-                "📝 Este libro ya está en tu lista de lectura. ¡Échale un vistazo!"
-            )
-            return
 
         try:
-            response = requests.get(f"{self.GOOGLE_BOOKS_URL}/{libro_id}")
-            response.raise_for_status()
-            libro_info = response.json()['volumeInfo']
-        except requests.RequestException:
+            libro_info = await self.obtener_info_volumen(libro_id)
+        except ErrorGoogleBooks:
             await query.edit_message_text("⚠️ Hubo un problema al obtener la información del libro.")
             return     
     
@@ -345,11 +566,16 @@ class CapituloCeroBot:
                 "google_id": libro_id,
                 "titulo": libro_info.get('title', 'Sin título'),
                 "autor": ', '.join(libro_info.get('authors', [])),
+                "categorias": libro_info.get('categories', []),
                 "fecha_agregado": datetime.now(),
                 "estado": "pendiente"
         }
             
-        self.lista_lectura.insert_one(libro)
+        if not await self.repositorio.agregar_a_lista(libro):
+            await query.message.reply_text(
+                "📝 Este libro ya está en tu lista de lectura. ¡Échale un vistazo!"
+            )
+            return
 
         texto = (
             f"🎉 El libro '{libro_info.get('title', 'Sin título')}' ha sido agregado a tu lista de lectura. ¡Disfrútalo pronto!\n"
@@ -357,7 +583,7 @@ class CapituloCeroBot:
 
         botones = [
             [
-                InlineKeyboardButton("🔙 Volver al inicio", callback_data="start")
+                InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))
             ]
         ]
         teclado = InlineKeyboardMarkup(botones)
@@ -366,53 +592,48 @@ class CapituloCeroBot:
     async def mostrar_lista_lectura(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
     
         user_id = update.effective_user.id
-        libros = list(self.lista_lectura.find({"user_id": user_id}))
+        pagina, despues, antes = self._leer_paginacion(update, context)
+        libros, anterior, siguiente = await self.repositorio.pagina_lista(user_id, despues, antes)
     
         if not libros:
-            await update.callback_query.message.reply_text(
+            await self._responder(
+                update,
                 "Tu lista de lectura está vacía. ¡Empieza a agregar libros!",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')]]
+                InlineKeyboardMarkup(
+                    [[InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))]]
                 )
             )
             return
     
-        for libro in libros:
-            texto = (
-                f"📖 {libro['titulo']}\n"
-                f"✍️ {libro['autor']}\n"
-                f"📅 Agregado el: {libro['fecha_agregado'].strftime('%d-%m-%Y')}\n"
+        texto = f"📝 Lista de Lectura (página {pagina + 1})\n\n"
+        keyboard = []
+        for numero, libro in enumerate(libros, start=1):
+            texto += (
+                f"{numero}. 📖 {libro['titulo']}\n"
+                f"    ✍️ {libro['autor']}\n"
+                f"    📅 Agregado el: {libro['fecha_agregado'].strftime('%d-%m-%Y')}\n\n"
             )
-        
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Marcar como leído", 
-                                        callback_data=f"marcar_leido_{libro['google_id']}"),
-                    InlineKeyboardButton("❌ Eliminar", 
-                                        callback_data=f"eliminar_lista_{libro['google_id']}")
-                ]
-            ]
+            keyboard.append([
+                InlineKeyboardButton(f"{numero}. ✅ Marcar como leído", 
+                                    callback_data=codificar('marcar_leido', libro['google_id'])),
+                InlineKeyboardButton(f"{numero}. ❌ Eliminar", 
+                                    callback_data=codificar('eliminar_lista', libro['google_id']))
+            ])
 
-            keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.callback_query.message.reply_text(texto, reply_markup=reply_markup)
+        keyboard += self._botones_paginacion('pagina_lista', pagina, libros, anterior, siguiente)
+        keyboard.append([InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))])
+        await self._responder(update, texto, InlineKeyboardMarkup(keyboard))
 
     async def marcar_como_leido(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        libro_id = query.data.split('_')[2]
+        libro_id = context.args[0]
         user_id = update.effective_user.id
     
    
-        libro = self.lista_lectura.find_one({"user_id": user_id, "google_id": libro_id})
+        libro = await self.repositorio.marcar_como_leido(user_id, libro_id)
         if not libro:
             await query.message.reply_text("El libro no se encontró en tu lista de lectura.")
             return
-    
-        libro["estado"] = "leído"
-        libro["fecha_leido"] = datetime.now()
-        self.biblioteca_personal.insert_one(libro)
-        
-        self.lista_lectura.delete_one({"user_id": user_id, "google_id": libro_id})
 
         await query.message.reply_text(
             f"🎉 ¡Felicidades por terminar '{libro['titulo']}'! 👏. Ha sido marcado como leído y agregado a tu biblioteca.\n"
@@ -422,10 +643,10 @@ class CapituloCeroBot:
 
     async def eliminar_de_lista(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        libro_id = query.data.split('_')[2]
+        libro_id = context.args[0]
         user_id = update.effective_user.id
     
-        self.lista_lectura.delete_one({"user_id": user_id, "google_id": libro_id})
+        await self.repositorio.eliminar_de_lista(user_id, libro_id)
     
         await query.message.reply_text("El libro ha sido eliminado de tu lista de lectura. 🗑️\n"
         "¡Espero encuentres algo mejor para leer pronto! 📚"
@@ -436,25 +657,26 @@ class CapituloCeroBot:
 
     async def mostrar_estadisticas(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
+
+        await self.escrituras.vaciar_usuario(user_id)
+        estadisticas = await self.repositorio.obtener_estadisticas(user_id)
+        if not estadisticas:
+            estadisticas, _ = await self.repositorio.reconstruir_estadisticas(user_id)
+
+        num_rating = estadisticas.get('num_rating', 0)
+        promedio_calificacion = estadisticas.get('suma_rating', 0) / num_rating if num_rating else 0
         
-        libros = list(self.biblioteca_personal.find({"user_id": user_id}))
-        libros_lista_lectura = list(self.lista_lectura.find({"user_id": user_id}))
-        libros_pendientes = len(libros_lista_lectura)
-        promedio_calificacion = sum(l.get('rating', 0) for l in libros) / len(libros) if libros else 0
-        
-        generos = {}
-        for libro in libros:
-            categorias = libro.get('categorias', [])
-            if isinstance(categorias, list):
-                for genero in categorias:
-                    generos[genero] = generos.get(genero, 0) + 1
-        
-        top_generos = sorted(generos.items(), key=lambda x: x[1], reverse=True)[:3]
+        generos = estadisticas.get('generos_biblioteca', {})
+        top_generos = sorted(
+            ((genero, cantidad) for genero, cantidad in generos.items() if cantidad > 0),
+            key=lambda x: x[1], reverse=True
+        )[:3]
         
         mensaje = (
             "📊 Tus Estadísticas de Lectura:\n\n"
-            f"📚 Total de libros: {len(libros)}\n"
-            f"📖 Libros pendientes: {libros_pendientes}\n"
+            f"📚 Total de libros: {estadisticas.get('total_biblioteca', 0)}\n"
+            f"✅ Libros leídos: {estadisticas.get('leidos', 0)}\n"
+            f"📖 Libros pendientes: {estadisticas.get('total_lista', 0)}\n"
             f"⭐ Calificación promedio: {promedio_calificacion:.1f}/10\n\n"
             "📘 Géneros favoritos:\n"
         )
@@ -467,66 +689,198 @@ class CapituloCeroBot:
 
         mensaje += "\n🚀 ¡Sigue así! Cada libro leído es un paso más hacia un mundo de conocimiento y aventuras. 🚀"
 
-        keyboard = [[InlineKeyboardButton("🔙 Volver al inicio", callback_data='start')]]
+        keyboard = [[InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         await update.callback_query.message.edit_text(mensaje, reply_markup=reply_markup)
 
+    async def mostrar_recomendaciones(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        libros = await self.recomendador.recomendar(user_id)
 
-if __name__ == '__main__':
+        keyboard = [[InlineKeyboardButton("🔙 Volver al inicio", callback_data=codificar('start'))]]
+        if not libros:
+            texto = (
+                "✨ Aún no tenemos recomendaciones para ti.\n\n"
+                "⭐ Califica con 6 o más los libros de tu biblioteca que te gustaron y vuelve en un rato."
+            )
+            await self._responder(update, texto, InlineKeyboardMarkup(keyboard))
+            return
 
-    TOKEN = 'BOT DE TOKEN ACA'
-    bot = CapituloCeroBot(TOKEN)
+        texto = "✨ Libros que te pueden gustar, según lectores con gustos parecidos a los tuyos:\n\n"
+        botones = []
+        for numero, libro in enumerate(libros, start=1):
+            texto += f"{numero}. 📖 {libro['titulo'] or 'Sin título'} — {libro['autor'] or 'Autor desconocido'}\n"
+            botones.append(InlineKeyboardButton(
+                f"{numero}. 📝 A mi lista", callback_data=codificar('add_lista', libro['google_id'])
+            ))
+        keyboard = [botones[i:i + 2] for i in range(0, len(botones), 2)] + keyboard
+        await self._responder(update, texto, InlineKeyboardMarkup(keyboard))
+
+    async def reconstruir_estadisticas(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        await self.escrituras.vaciar_usuario(user_id)
+        _, diferencias = await self.repositorio.reconstruir_estadisticas(user_id)
+
+        if diferencias is None:
+            mensaje = "📊 Tus estadísticas se han calculado desde cero."
+        elif not diferencias:
+            mensaje = "📊 Tus estadísticas ya estaban al día. ✅"
+        else:
+            mensaje = f"📊 Tus estadísticas se han corregido 🔧 ({', '.join(diferencias)})."
+        await update.message.reply_text(mensaje)
+
+
+def crear_aplicacion(token, bot=None, request=None, con_updater=True, limitador=None, procesador=None):
+    bot = bot or CapituloCeroBot(token)
+    # Usuarios distintos en paralelo, cada usuario en orden
+    procesador = procesador or ProcesadorPorUsuario()
+    bot.metricas.registrar_indicador(
+        'capitulo_cola_updates', 'Updates admitidos, en proceso, usuarios con cola y esperando sitio en la cola de su usuario.',
+        procesador.metricas
+    )
 
     # Configuracion de handlers
-    application = Application.builder().token(TOKEN).build()
-    
+    builder = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(limitador or LimitadorEnvios())
+        .concurrent_updates(procesador)
+        .persistence(PersistenciaMongo(bot.repositorio.db))
+        .post_init(bot.inicializar)
+        .post_shutdown(bot.cerrar)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    if not con_updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Cada handler registra su latencia y el desglose por componente
+    instrumentar = bot.metricas.instrumentar
+
+    # Entry points de las conversaciones: necesitan su propio CallbackQueryHandler
+    def boton(callback, accion):
+        return CallbackQueryHandler(instrumentar(callback, accion), pattern=patron(accion))
+
     # Handler para búsqueda de libros
     conv_handler_busqueda = ConversationHandler(
-        entry_points=[CallbackQueryHandler(bot.buscar_libro, pattern='^buscar_libro$')],
+        entry_points=[boton(bot.buscar_libro, 'buscar_libro')],
         states={
-            'esperando_busqueda': [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.procesar_busqueda)]
+            'esperando_busqueda': [MessageHandler(filters.TEXT & ~filters.COMMAND, instrumentar(bot.procesar_busqueda))]
         },
-        fallbacks=[]
+        fallbacks=[],
+        name='busqueda',
+        persistent=True
     )
 
-    conv_handler_calificacion = ConversationHandler(
-        entry_points=[CallbackQueryHandler(bot.calificar_libro, pattern='^calificar_libro$')],
+    conv_handler_busqueda_propia = ConversationHandler(
+        entry_points=[
+            boton(bot.buscar_mis_libros, 'buscar_mis_libros'),
+            CommandHandler("buscar_mis_libros", instrumentar(bot.buscar_mis_libros))
+        ],
         states={
-            'esperando_calificacion': [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.guardar_calificacion)],
+            'esperando_busqueda_propia': [MessageHandler(filters.TEXT & ~filters.COMMAND, instrumentar(bot.procesar_busqueda_propia))]
         },
-        fallbacks=[]
+        fallbacks=[],
+        name='busqueda_propia',
+        persistent=True
     )
 
-    
-    # Start
-    application.add_handler(CommandHandler("start", bot.start))
-    application.add_handler(CallbackQueryHandler(bot.start, pattern='^start$'))
-    application.add_handler(CommandHandler("biblioteca", bot.mostrar_biblioteca))
+    conv_handler_calificacion = ConversationHandler(
+        entry_points=[boton(bot.calificar_libro, 'calificar_libro')],
+        states={
+            'esperando_calificacion': [MessageHandler(filters.TEXT & ~filters.COMMAND, instrumentar(bot.guardar_calificacion))],
+        },
+        fallbacks=[],
+        name='calificacion',
+        persistent=True
+    )
 
-    # Conversation para búsquedas
+    # El resto de botones se resuelve con un unico handler y un dict por accion
+    despachador = Despachador()
+    botones = {
+        # Start
+        'start': bot.start,
+        # Biblioteca
+        'mi_biblioteca': bot.mostrar_biblioteca,
+        'pagina_biblioteca': bot.mostrar_biblioteca,
+        'add_biblioteca': bot.agregar_a_biblioteca,
+        'eliminar_biblioteca': bot.eliminar_de_biblioteca,
+        'detalles_biblioteca': bot.detalles_libro_biblioteca,
+        # Lista de lectura
+        'add_lista': bot.agregar_a_lista_lectura,
+        'lista_lectura': bot.mostrar_lista_lectura,
+        'pagina_lista': bot.mostrar_lista_lectura,
+        'marcar_leido': bot.marcar_como_leido,
+        'eliminar_lista': bot.eliminar_de_lista,
+        # Búsqueda en mis libros
+        'pagina_mis_libros': bot.mostrar_busqueda_propia,
+        # Estadísticas y recomendaciones
+        'estadisticas': bot.mostrar_estadisticas,
+        'recomendaciones': bot.mostrar_recomendaciones,
+        # Calificaciones
+        'calificar_libro': bot.calificar_libro,
+        'calificar_biblioteca': bot.solicitar_calificacion,
+        'calificacion': bot.guardar_calificacion,
+    }
+    for accion, callback in botones.items():
+        despachador.registrar(accion, instrumentar(callback, accion))
+
+    # Comandos
+    application.add_handler(CommandHandler("start", instrumentar(bot.start)))
+    application.add_handler(CommandHandler("biblioteca", instrumentar(bot.mostrar_biblioteca)))
+    application.add_handler(CommandHandler("reconstruir_estadisticas", instrumentar(bot.reconstruir_estadisticas)))
+    application.add_handler(CommandHandler("recomendaciones", instrumentar(bot.mostrar_recomendaciones)))
+
+    # Conversaciones
     application.add_handler(conv_handler_busqueda)
+    application.add_handler(conv_handler_busqueda_propia)
 
-    # Callbacks para agregar libros y gestionar la biblioteca
-    application.add_handler(CallbackQueryHandler(bot.mostrar_biblioteca, pattern='^mi_biblioteca$'))
-    application.add_handler(CallbackQueryHandler(bot.agregar_a_biblioteca, pattern='^add_biblioteca_'))
-    application.add_handler(CallbackQueryHandler(bot.eliminar_de_biblioteca, pattern='^eliminar_biblioteca_'))
-    application.add_handler(CallbackQueryHandler(bot.detalles_libro_biblioteca, pattern='^detalles_biblioteca_'))
-    application.add_handler(CallbackQueryHandler(bot.agregar_a_lista_lectura, pattern='^add_lista_'))
-    application.add_handler(CallbackQueryHandler(bot.mostrar_lista_lectura, pattern='^lista_lectura$'))
-    application.add_handler(CallbackQueryHandler(bot.marcar_como_leido, pattern='^marcar_leido_'))
-    application.add_handler(CallbackQueryHandler(bot.eliminar_de_lista, pattern='^eliminar_lista_'))
-
-    # Estadísticas
-    application.add_handler(CallbackQueryHandler(bot.mostrar_estadisticas, pattern='^estadisticas$'))
-
-    # Calificaciones
-    application.add_handler(CallbackQueryHandler(bot.solicitar_calificacion, pattern='^calificar_biblioteca_'))
-    application.add_handler(CallbackQueryHandler(bot.guardar_calificacion, pattern='^calificacion_'))
-    application.add_handler(CallbackQueryHandler(bot.calificar_libro, pattern='^calificar_libro$'))
-    application.add_handler(CallbackQueryHandler(bot.solicitar_calificacion, pattern='^rate_'))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.guardar_calificacion))
-    
-    # Iniciar el bot
-    print("Bot iniciado")
-    application.run_polling()
\ No newline at end of file
+    # Botones
+    application.add_handler(CallbackQueryHandler(despachador))
+
+    # Búsqueda inline (@bot título): sin bloquear para poder cancelar la anterior
+    application.add_handler(InlineQueryHandler(instrumentar(bot.inline.responder), block=False))
+
+    # Importación y exportación
+    application.add_handler(CommandHandler("importar", instrumentar(bot.importador.pedir_archivo)))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv"), instrumentar(bot.importador.importar)))
+    application.add_handler(CommandHandler("exportar", instrumentar(bot.importador.exportar)))
+
+    # Calificación escrita como texto
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumentar(bot.guardar_calificacion)))
+
+    return application
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Capítulo Cero Bot")
+    parser.add_argument('--modo', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--workers', type=int, default=4, help="Procesos de trabajo en modo webhook")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8443)
+    parser.add_argument('--ruta', default='/webhook')
+    parser.add_argument('--url-publica', help="URL completa del webhook que se registra en Telegram")
+    parser.add_argument('--secreto', default=os.environ.get('WEBHOOK_SECRETO'))
+    parser.add_argument('--sin-telegram', action='store_true',
+                        help="Responde localmente a la Bot API en lugar de llamar a Telegram (pruebas)")
+    args = parser.parse_args()
+
+    TOKEN = os.environ.get('TELEGRAM_TOKEN', 'BOT DE TOKEN ACA')
+
+    if args.modo == 'webhook':
+        from webhook import servir_webhook
+
+        print(f"Bot iniciado en modo webhook con {args.workers} workers")
+        asyncio.run(servir_webhook(
+            TOKEN, workers=args.workers, host=args.host, puerto=args.puerto, ruta=args.ruta,
+            url_publica=args.url_publica, secreto=args.secreto, sin_telegram=args.sin_telegram
+        ))
+    else:
+        application = crear_aplicacion(TOKEN)
+
+        # Iniciar el bot
+        print("Bot iniciado")
+        application.run_polling()
@@ -0,0 +1,496 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+from telegram import Update
+
+from CapituloCeroBot import CapituloCeroBot, crear_aplicacion
+from callbacks import codificar
+from envios import LimitadorEnvios
+from google_books import ClienteGoogleBooks
+from recomendaciones import MatrizValoraciones, Recomendador, disponible, np, vecinos_similares
+from repositorio import RepositorioMongo
+from servidor_http import servir
+from telegram_local import PeticionLocal
+
+
+# Pesos de cada accion de usuario en las distintas mezclas de trafico
+MEZCLAS = {
+    'equilibrada': {
+        'start': 10, 'buscar': 25, 'agregar_biblioteca': 12, 'agregar_lista': 8,
+        'ver_biblioteca': 15, 'ver_lista': 8, 'detalles': 7, 'calificar': 8,
+        'marcar_leido': 3, 'estadisticas': 4
+    },
+    'busqueda': {
+        'start': 5, 'buscar': 60, 'agregar_biblioteca': 15, 'agregar_lista': 10,
+        'ver_biblioteca': 5, 'estadisticas': 5
+    },
+    'navegacion': {
+        'start': 20, 'buscar': 5, 'agregar_biblioteca': 5, 'ver_biblioteca': 30,
+        'ver_lista': 15, 'detalles': 10, 'calificar': 10, 'estadisticas': 5
+    },
+}
+
+CONSULTAS = [
+    "cien años de soledad", "don quijote", "el principito", "rayuela", "la sombra del viento",
+    "1984", "fahrenheit 451", "el nombre de la rosa", "pedro páramo", "ficciones",
+    "la casa de los espíritus", "crónica de una muerte anunciada", "el túnel", "niebla",
+    "la ciudad y los perros", "el amor en los tiempos del cólera", "sapiens", "dune",
+    "fundación", "el señor de los anillos", "harry potter", "los juegos del hambre",
+]
+GENEROS = ["Fiction", "History", "Science", "Poetry", "Biography & Autobiography", "Juvenile Fiction"]
+
+
+# Google Books falso
+
+def id_volumen(semilla):
+    return hashlib.sha1(semilla.encode()).hexdigest()[:12]
+
+
+def volumen_falso(libro_id):
+    aleatorio = random.Random(libro_id)
+    return {
+        "id": libro_id,
+        "volumeInfo": {
+            "title": f"Libro {libro_id[:6]}",
+            "authors": [f"Autor {aleatorio.randint(1, 500)}"],
+            "description": "Descripción de prueba. " * 20,
+            "categories": [aleatorio.choice(GENEROS)],
+            "publishedDate": str(aleatorio.randint(1900, 2024)),
+            "imageLinks": {"thumbnail": f"http://books.google.com/books/content?id={libro_id}"},
+            "industryIdentifiers": [{"type": "ISBN_13", "identifier": str(9780000000000 + aleatorio.randint(0, 10 ** 9))}]
+        }
+    }
+
+
+class GoogleBooksFalso:
+    # Servidor HTTP local que imita /books/v1/volumes con latencia y tasa de
+    # errores configurables. 'caidas' es una lista de (inicio, fin) en segundos
+    # desde el arranque durante los que todas las peticiones fallan con 503,
+    # o se quedan colgadas 'espera_caida' segundos si se indica.
+    def __init__(self, latencia=0.05, jitter=0.02, tasa_errores=0.0, caidas=(), espera_caida=0.0):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.tasa_errores = tasa_errores
+        self.caidas = caidas
+        self.espera_caida = espera_caida
+        self.peticiones = 0
+        self.errores = 0
+        self._inicio = time.monotonic()
+
+    def en_caida(self):
+        transcurrido = time.monotonic() - self._inicio
+        return any(inicio <= transcurrido < fin for inicio, fin in self.caidas)
+
+    async def atender(self, peticion):
+        self.peticiones += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latencia, self.jitter)))
+        if self.en_caida() and self.espera_caida:
+            self.errores += 1
+            await asyncio.sleep(self.espera_caida)
+            return 504, 'text/html', b'<html>Gateway Timeout</html>'
+        if self.en_caida() or random.random() < self.tasa_errores:
+            self.errores += 1
+            return 503, 'text/html', b'<html>Service Unavailable</html>'
+
+        partes = peticion.ruta.rstrip('/').split('/')
+        if partes[-1] == 'volumes':
+            consulta = peticion.consulta.get("q", [""])[0]
+            maximo = int(peticion.consulta.get('maxResults', ['10'])[0])
+            items = [volumen_falso(id_volumen(f"{consulta}:{i}")) for i in range(maximo)]
+            cuerpo = {"kind": "books#volumes", "totalItems": len(items), "items": items}
+        else:
+            cuerpo = volumen_falso(partes[-1])
+        return 200, 'application/json', json.dumps(cuerpo).encode()
+
+    async def iniciar(self, puerto=0):
+        self._inicio = time.monotonic()
+        self.servidor = await servir(self.atender, '127.0.0.1', puerto)
+        puerto = self.servidor.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{puerto}/books/v1/volumes"
+
+
+# Updates sinteticos
+
+class UsuarioSintetico:
+    def __init__(self, user_id, aleatorio, contador):
+        self.user_id = user_id
+        self.aleatorio = aleatorio
+        self.contador = contador
+        self.conocidos = []
+        self.biblioteca = []
+        self.lista = []
+
+    def _usuario(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"Lector{self.user_id}",
+                "username": f"lector{self.user_id}"}
+
+    def _mensaje(self, texto, comando=False):
+        mensaje = {"message_id": next(self.contador), "date": int(time.time()),
+                   "chat": {"id": self.user_id, "type": "private"}, "from": self._usuario(),
+                   "text": texto}
+        if comando:
+            mensaje["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        return {"update_id": next(self.contador), "message": mensaje}
+
+    def _boton(self, accion, *args):
+        datos = codificar(accion, *args)
+        return {"update_id": next(self.contador), "callback_query": {
+            "id": str(next(self.contador)), "from": self._usuario(), "chat_instance": str(self.user_id),
+            "data": datos,
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": self.user_id, "type": "private"}, "text": "menú"}
+        }}
+
+    def _elegir(self, libros):
+        return self.aleatorio.choice(libros) if libros else id_volumen(f"extra:{self.aleatorio.random()}")
+
+    def accion(self, nombre):
+        # Devuelve la secuencia de (handler, update) que genera la accion
+        if nombre == 'start':
+            return [('start', self._mensaje('/start', comando=True))]
+        if nombre == 'buscar':
+            consulta = self.aleatorio.choices(CONSULTAS, weights=[1 / (i + 1) for i in range(len(CONSULTAS))])[0]
+            self.conocidos.extend(id_volumen(f"{consulta}:{i}") for i in range(3))
+            return [('buscar_libro', self._boton('buscar_libro')),
+                    ('procesar_busqueda', self._mensaje(consulta))]
+        if nombre == 'agregar_biblioteca':
+            libro_id = self._elegir(self.conocidos)
+            self.biblioteca.append(libro_id)
+            return [('agregar_a_biblioteca', self._boton('add_biblioteca', libro_id))]
+        if nombre == 'agregar_lista':
+            libro_id = self._elegir(self.conocidos)
+            self.lista.append(libro_id)
+            return [('agregar_a_lista_lectura', self._boton('add_lista', libro_id))]
+        if nombre == 'ver_biblioteca':
+            return [('mostrar_biblioteca', self._boton('mi_biblioteca'))]
+        if nombre == 'ver_lista':
+            return [('mostrar_lista_lectura', self._boton('lista_lectura'))]
+        if nombre == 'detalles':
+            return [('detalles_libro_biblioteca', self._boton('detalles_biblioteca', self._elegir(self.biblioteca)))]
+        if nombre == 'calificar':
+            libro_id = self._elegir(self.biblioteca)
+            return [('solicitar_calificacion', self._boton('calificar_biblioteca', libro_id)),
+                    ('guardar_calificacion', self._boton('calificacion', libro_id, self.aleatorio.randint(1, 10)))]
+        if nombre == 'marcar_leido':
+            libro_id = self.lista.pop() if self.lista else self._elegir([])
+            self.biblioteca.append(libro_id)
+            return [('marcar_como_leido', self._boton('marcar_leido', libro_id))]
+        if nombre == 'estadisticas':
+            return [('mostrar_estadisticas', self._boton('estadisticas'))]
+        raise ValueError(f"Acción desconocida: {nombre}")
+
+
+# Ejecucion y metricas
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def resumir(latencias, errores):
+    resumen = {}
+    for handler, valores in sorted(latencias.items()):
+        resumen[handler] = {
+            "n": len(valores),
+            "errores": errores.get(handler, 0),
+            "media_ms": round(sum(valores) / len(valores) * 1000, 2),
+            "p50_ms": round(percentil(valores, 50) * 1000, 2),
+            "p95_ms": round(percentil(valores, 95) * 1000, 2),
+            "p99_ms": round(percentil(valores, 99) * 1000, 2),
+        }
+    return resumen
+
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def crear_repositorio(mongo_uri):
+    if mongo_uri:
+        return RepositorioMongo(uri=mongo_uri, nombre_db=f"benchmark_{int(time.time())}")
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("Instala mongomock-motor o indica --mongo-uri para usar un mongod local")
+    return RepositorioMongo(cliente=AsyncMongoMockClient(), transacciones=False)
+
+
+async def ejecutar(args):
+    random.seed(args.semilla)
+    google = GoogleBooksFalso(args.latencia_google / 1000, args.latencia_google / 4000,
+                              args.errores_google, args.caidas, args.espera_caida)
+    url_google = await google.iniciar()
+
+    repositorio = await crear_repositorio(args.mongo_uri)
+    bot = CapituloCeroBot('benchmark', repositorio=repositorio,
+                          google_books=ClienteGoogleBooks(url_base=url_google, cuota_minuto=args.cuota_google))
+    # Sin limitador se mide solo el coste de los handlers; con el se incluye
+    # la espera impuesta por los limites de Telegram (1 msg/s por chat).
+    limitador = LimitadorEnvios(tasa_global=10 ** 6, tasa_chat=10 ** 6, tasa_grupo=10 ** 6) if args.sin_limitador else None
+    application = crear_aplicacion('1:benchmark', bot=bot, con_updater=False, limitador=limitador,
+                                   request=PeticionLocal(latencia=args.latencia_telegram / 1000))
+
+    latencias = {}
+    errores = {}
+    en_curso = {}
+
+    async def contar_error(update, context):
+        handler = en_curso.get(getattr(update, 'update_id', None), 'desconocido')
+        errores[handler] = errores.get(handler, 0) + 1
+
+    application.add_error_handler(contar_error)
+
+    pesos = MEZCLAS[args.mezcla]
+    contador = itertools.count(1)
+
+    async def usuario_virtual(indice):
+        aleatorio = random.Random(args.semilla * 100003 + indice)
+        usuario = UsuarioSintetico(10_000 + indice, aleatorio, contador)
+        for _ in range(args.acciones):
+            accion = aleatorio.choices(list(pesos), weights=list(pesos.values()))[0]
+            for handler, datos in usuario.accion(accion):
+                update = Update.de_json(datos, application.bot)
+                en_curso[update.update_id] = handler
+                inicio = time.perf_counter()
+                # Por el mismo planificador que usa el bot: la latencia incluye la espera en cola
+                await application.update_processor.process_update(update, application.process_update(update))
+                latencias.setdefault(handler, []).append(time.perf_counter() - inicio)
+                en_curso.pop(update.update_id, None)
+            if args.pausa:
+                await asyncio.sleep(aleatorio.expovariate(1000 / args.pausa))
+
+    async def inundar():
+        # Un usuario que envia de golpe 'inundacion' updates: los demas no
+        # deberian esperar detras de su cola. Sus latencias no se cuentan.
+        usuario = UsuarioSintetico(9_999, random.Random(args.semilla), contador)
+        updates = [Update.de_json(datos, application.bot)
+                   for _ in range(args.inundacion) for _, datos in usuario.accion('start')]
+        await asyncio.gather(*(
+            application.update_processor.process_update(update, application.process_update(update))
+            for update in updates
+        ))
+
+    async with application:
+        await application.post_init(application)
+        inicio = time.perf_counter()
+        inundacion = asyncio.create_task(inundar()) if args.inundacion else None
+        await asyncio.gather(*(usuario_virtual(i) for i in range(args.usuarios)))
+        duracion = time.perf_counter() - inicio
+        if inundacion:
+            await inundacion
+    await application.post_shutdown(application)
+    google.servidor.close()
+
+    total = sum(len(valores) for valores in latencias.values())
+    return {
+        "commit": commit_actual(),
+        "fecha": datetime.now().isoformat(timespec='seconds'),
+        "parametros": vars(args),
+        "total_updates": total,
+        "duracion_s": round(duracion, 3),
+        "updates_por_segundo": round(total / duracion, 1) if duracion else 0,
+        "peticiones_google": google.peticiones,
+        "errores_google": google.errores,
+        "cliente_google": bot.google_books.metricas(),
+        "handlers": resumir(latencias, errores),
+    }
+
+
+def valoraciones_sinteticas(aleatorio, cantidad, lectores, libros):
+    # Popularidad de libros y actividad de lectores con cola larga (Zipf)
+    def zipf(n, exponente):
+        pesos = 1.0 / np.arange(1, n + 1) ** exponente
+        return aleatorio.choice(n, cantidad, p=pesos / pesos.sum())
+
+    usuarios = zipf(lectores, 0.6)
+    google_ids = zipf(libros, 0.9)
+    calificaciones = aleatorio.integers(1, 11, cantidad)
+    return list(zip(usuarios.tolist(), (f"v{i}" for i in google_ids.tolist()), calificaciones.tolist()))
+
+
+def medir_recomendaciones(args):
+    # Construccion completa de la matriz y los vecinos y una actualizacion
+    # incremental con un lote de calificaciones nuevas, sin Mongo ni Telegram
+    aleatorio = np.random.default_rng(args.semilla)
+    valoraciones = valoraciones_sinteticas(aleatorio, args.valoraciones, args.lectores, args.libros)
+    nuevas = valoraciones_sinteticas(aleatorio, args.lote, args.lectores, args.libros)
+
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    matriz = MatrizValoraciones()
+    columnas = matriz.aplicar(valoraciones)
+    carga = time.perf_counter() - inicio
+    vecinos = sum(len(filas) for _, filas, _ in vecinos_similares(matriz.matriz, columnas))
+    completa = time.perf_counter() - inicio
+    _, pico_completa = tracemalloc.get_traced_memory()
+
+    tracemalloc.reset_peak()
+    inicio = time.perf_counter()
+    afectadas = matriz.aplicar(nuevas)
+    for _ in vecinos_similares(matriz.matriz, afectadas):
+        pass
+    incremental = time.perf_counter() - inicio
+    _, pico_incremental = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # mongomock recorre la coleccion en cada operacion: sin un mongod real
+    # solo mediria a mongomock
+    desde_mongo = asyncio.run(medir_carga_recomendaciones(args, valoraciones)) if args.mongo_uri else {}
+    return {
+        "commit": commit_actual(),
+        "fecha": datetime.now().isoformat(timespec='seconds'),
+        "parametros": vars(args),
+        "valoraciones": matriz.matriz.nnz,
+        "lectores": matriz.matriz.shape[0],
+        "libros": matriz.matriz.shape[1],
+        "vecinos_guardados": vecinos,
+        "carga_matriz_s": round(carga, 3),
+        "construccion_completa_s": round(completa, 3),
+        "pico_memoria_completa_mb": round(pico_completa / 2 ** 20, 1),
+        "libros_recalculados": len(afectadas),
+        "actualizacion_incremental_s": round(incremental, 3),
+        "pico_memoria_incremental_mb": round(pico_incremental / 2 ** 20, 1),
+        **desde_mongo,
+    }
+
+
+async def medir_carga_recomendaciones(args, valoraciones):
+    # Construccion completa como la hace el bot: leyendo las calificaciones
+    # de Mongo. Mide tambien el bloqueo maximo del bucle de eventos, que es
+    # lo que notarian los handlers mientras se calcula.
+    repositorio = await crear_repositorio(args.mongo_uri)
+    ahora = datetime.now()
+    for inicio in range(0, len(valoraciones), 10_000):
+        await repositorio.biblioteca_personal.insert_many([
+            {"user_id": user_id, "google_id": google_id, "titulo": f"Libro {google_id}", "autor": "Autor",
+             "rating": rating, "fecha_calificacion": ahora}
+            for user_id, google_id, rating in valoraciones[inicio:inicio + 10_000]
+        ])
+    google_ids = sorted({google_id for _, google_id, _ in valoraciones})
+    for inicio in range(0, len(google_ids), 10_000):
+        await repositorio.volumenes.insert_many([
+            {"_id": google_id, "volumeInfo": {"title": f"Libro {google_id}", "authors": ["Autor"]}}
+            for google_id in google_ids[inicio:inicio + 10_000]
+        ])
+
+    bloqueo = 0.0
+
+    async def vigilar():
+        nonlocal bloqueo
+        while True:
+            antes = time.perf_counter()
+            await asyncio.sleep(0.01)
+            bloqueo = max(bloqueo, time.perf_counter() - antes - 0.01)
+
+    recomendador = Recomendador(repositorio)
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    vigilante = asyncio.create_task(vigilar())
+    inicio = time.perf_counter()
+    await recomendador.actualizar()
+    duracion = time.perf_counter() - inicio
+    vigilante.cancel()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    repositorio.cerrar()
+
+    return {
+        "construccion_desde_mongo_s": round(duracion, 3),
+        "pico_memoria_desde_mongo_mb": round((pico - base) / 2 ** 20, 1),
+        "bloqueo_maximo_bucle_ms": round(bloqueo * 1000, 1),
+    }
+
+
+def imprimir(resultado, base=None):
+    print(f"\nCommit {resultado['commit']} · {resultado['total_updates']} updates en "
+          f"{resultado['duracion_s']}s · {resultado['updates_por_segundo']} updates/s · "
+          f"{resultado['peticiones_google']} peticiones a Google ({resultado['errores_google']} con error)")
+    if 'cliente_google' in resultado:
+        cliente = resultado['cliente_google']
+        print(f"Cliente de Google: {cliente['aperturas']} aperturas del circuito · {cliente['reintentos']} reintentos · "
+              f"{cliente['rechazadas_circuito']} rechazadas por el circuito · {cliente['rechazadas_cuota']} por la cuota")
+    print()
+    print(f"{'handler':<28}{'n':>7}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for handler, datos in resultado['handlers'].items():
+        linea = (f"{handler:<28}{datos['n']:>7}{datos['errores']:>6}"
+                 f"{datos['p50_ms']:>10}{datos['p95_ms']:>10}{datos['p99_ms']:>10}")
+        if base and handler in base['handlers'] and base['handlers'][handler]['p99_ms']:
+            cambio = datos['p99_ms'] / base['handlers'][handler]['p99_ms'] - 1
+            linea += f"   p99 {cambio:+.0%}"
+        print(linea)
+
+
+def leer_caidas(texto):
+    # "5-10,20-25" -> [(5.0, 10.0), (20.0, 25.0)]
+    caidas = []
+    for tramo in filter(None, texto.split(',')):
+        inicio, fin = tramo.split('-')
+        caidas.append((float(inicio), float(fin)))
+    return caidas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de carga de Capítulo Cero Bot")
+    parser.add_argument('--usuarios', type=int, default=50, help="Usuarios virtuales concurrentes")
+    parser.add_argument('--acciones', type=int, default=40, help="Acciones por usuario")
+    parser.add_argument('--mezcla', choices=sorted(MEZCLAS), default='equilibrada')
+    parser.add_argument('--pausa', type=float, default=1000.0, help="Pausa media entre acciones de un usuario (ms)")
+    parser.add_argument('--latencia-google', type=float, default=80.0, help="Latencia media de Google Books (ms)")
+    parser.add_argument('--errores-google', type=float, default=0.0, help="Fracción de peticiones con 503")
+    parser.add_argument('--caidas', type=leer_caidas, default=[], help="Caídas de Google, p. ej. '5-10,20-25' (s)")
+    parser.add_argument('--espera-caida', type=float, default=0.0,
+                        help="Durante las caídas Google se cuelga estos segundos en lugar de responder 503")
+    parser.add_argument('--cuota-google', type=int, default=0, help="Peticiones a Google por minuto (0 sin límite)")
+    parser.add_argument('--latencia-telegram', type=float, default=30.0, help="Latencia de la Bot API (ms)")
+    parser.add_argument('--sin-limitador', action='store_true',
+                        help="Desactiva los límites de envío de Telegram para medir solo los handlers")
+    parser.add_argument('--inundacion', type=int, default=0,
+                        help="Updates que un usuario extra envía de golpe al empezar")
+    parser.add_argument('--mongo-uri', help="mongod local; si no se indica se usa mongomock-motor en memoria")
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--salida', help="Fichero JSON donde guardar los resultados")
+    parser.add_argument('--comparar', help="Resultados JSON de otro commit con los que comparar")
+    parser.add_argument('--recomendaciones', action='store_true',
+                        help="Mide la construcción de recomendaciones con calificaciones sintéticas")
+    parser.add_argument('--valoraciones', type=int, default=2_000_000, help="Calificaciones sintéticas")
+    parser.add_argument('--lectores', type=int, default=200_000, help="Lectores distintos como máximo")
+    parser.add_argument('--libros', type=int, default=100_000, help="Libros distintos como máximo")
+    parser.add_argument('--lote', type=int, default=10_000, help="Calificaciones nuevas de la actualización incremental")
+    args = parser.parse_args()
+
+    if args.recomendaciones:
+        if not disponible():
+            parser.error("--recomendaciones necesita NumPy y SciPy")
+        resultado = medir_recomendaciones(args)
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+        if args.salida:
+            with open(args.salida, 'w', encoding='utf-8') as f:
+                json.dump(resultado, f, ensure_ascii=False, indent=2)
+        raise SystemExit
+
+    resultado = asyncio.run(ejecutar(args))
+    base = None
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)
+    imprimir(resultado, base)
+
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados guardados en {args.salida}")
@@ -0,0 +1,96 @@
+import asyncio
+
+from telegram import InlineQueryResultArticle, InlineQueryResultsButton, InputTextMessageContent, Update
+from telegram.ext import ContextTypes
+
+from cache import CacheLRU, normalizar_consulta
+from repositorio import tokens_busqueda
+
+
+MIN_CARACTERES = 3
+ESPERA = 0.4
+MAX_RESULTADOS = 10
+CACHE_TELEGRAM = 300
+CACHE_TELEGRAM_CON_AVISO = 10
+AVISO_INLINE = "⚠️ Google Books no responde ahora mismo"
+TTL_RECIENTES = 120
+
+
+def _coincide(libro, terminos):
+    # Cada termino debe ser prefijo de alguna palabra del titulo o del autor
+    palabras = tokens_busqueda(libro['titulo'], libro['autor'])
+    return all(any(palabra.startswith(termino) for palabra in palabras) for termino in terminos)
+
+
+class BusquedaInline:
+    # @bot <título>: Telegram envia una inline query por cada tecla. Para no
+    # hacer una busqueda en Google por pulsacion:
+    # - se espera ESPERA segundos antes de ir a Google, y la consulta anterior
+    #   del mismo usuario (en espera o en vuelo) se cancela al llegar otra;
+    # - si la consulta nueva amplia o recorta la ultima que se busco, se
+    #   filtran esos resultados en lugar de volver a buscar;
+    # - cache_time e is_personal dejan que Telegram responda las repetidas.
+    def __init__(self, bot):
+        self.bot = bot
+        self._tareas = {}
+        self._recientes = CacheLRU(max_elementos=10000, ttl=TTL_RECIENTES)
+
+    async def responder(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        inline_query = update.inline_query
+        user_id = update.effective_user.id
+        consulta = normalizar_consulta(inline_query.query)
+
+        anterior = self._tareas.pop(user_id, None)
+        if anterior is not None:
+            anterior.cancel()
+        if len(consulta) < MIN_CARACTERES:
+            await inline_query.answer([], cache_time=CACHE_TELEGRAM, is_personal=True)
+            return
+
+        tarea = asyncio.current_task()
+        self._tareas[user_id] = tarea
+        try:
+            libros, aviso = self._desde_recientes(user_id, consulta), None
+            if libros is None:
+                await asyncio.sleep(ESPERA)
+                libros, aviso = await self.bot.buscar_libro_google(consulta, max_resultados=MAX_RESULTADOS)
+                if not aviso:
+                    self._recientes.guardar(user_id, (consulta, libros))
+            # Con Google fallando se avisa encima de los resultados y no se deja
+            # que Telegram guarde la respuesta
+            await inline_query.answer(
+                [self._resultado(libro) for libro in libros],
+                cache_time=CACHE_TELEGRAM_CON_AVISO if aviso else CACHE_TELEGRAM,
+                is_personal=True,
+                button=InlineQueryResultsButton(text=AVISO_INLINE, start_parameter='inicio') if aviso else None
+            )
+        finally:
+            if self._tareas.get(user_id) is tarea:
+                del self._tareas[user_id]
+
+    def _desde_recientes(self, user_id, consulta):
+        reciente = self._recientes.obtener(user_id)
+        if reciente is None:
+            return None
+        consulta_anterior, libros = reciente
+        if not (consulta.startswith(consulta_anterior) or consulta_anterior.startswith(consulta)):
+            return None
+        terminos = tokens_busqueda(consulta)
+        filtrados = [libro for libro in libros if _coincide(libro, terminos)]
+        # Sin coincidencias puede que Google si tenga resultados: se busca
+        return filtrados or None
+
+    def _resultado(self, libro):
+        texto = (
+            f"📖 {libro['titulo']}\n"
+            f"✍️ {libro['autor']}\n"
+            f"📅 {libro['fecha_publicacion']}\n\n"
+            f"📝 {libro['descripcion'][:300]}..."
+        )
+        return InlineQueryResultArticle(
+            id=libro['id_google'],
+            title=libro['titulo'],
+            description=libro['autor'],
+            thumbnail_url=libro['imagen'],
+            input_message_content=InputTextMessageContent(texto)
+        )
@@ -0,0 +1,224 @@
+import asyncio
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from google_books import isbns_de
+from metricas import medir
+
+
+class CacheLRU:
+    def __init__(self, max_elementos=1000, ttl=3600):
+        self.max_elementos = max_elementos
+        self.ttl = ttl
+        self._datos = OrderedDict()
+
+    def obtener(self, clave):
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        valor, expira = entrada
+        if expira < time.monotonic():
+            del self._datos[clave]
+            return None
+        self._datos.move_to_end(clave)
+        return valor
+
+    def guardar(self, clave, valor):
+        self._datos[clave] = (valor, time.monotonic() + self.ttl)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.max_elementos:
+            self._datos.popitem(last=False)
+
+    def eliminar(self, clave):
+        self._datos.pop(clave, None)
+
+    def __len__(self):
+        return len(self._datos)
+
+
+class CacheVolumenes:
+    # volumeInfo de Google Books por id_google: LRU en memoria delante de una
+    # coleccion de Mongo para que la cache sobreviva a los reinicios.
+    def __init__(self, coleccion, max_elementos=5000, ttl=3600, ttl_persistente=timedelta(days=7)):
+        self.coleccion = coleccion
+        self.memoria = CacheLRU(max_elementos, ttl)
+        self.ttl_persistente = ttl_persistente
+
+    async def obtener(self, libro_id, caducado=False):
+        # caducado=True devuelve la copia de Mongo aunque haya pasado el TTL;
+        # se usa cuando Google no responde
+        info = self.memoria.obtener(libro_id)
+        if info is not None:
+            return info
+
+        with medir('db'):
+            doc = await self.coleccion.find_one({"_id": libro_id})
+        if not doc or (not caducado and doc['actualizado'] < datetime.now() - self.ttl_persistente):
+            return None
+        self.memoria.guardar(libro_id, doc['volumeInfo'])
+        return doc['volumeInfo']
+
+    async def buscar_isbn(self, isbn):
+        # Devuelve (id_google, volumeInfo) de un volumen ya conocido con ese ISBN
+        with medir('db'):
+            doc = await self.coleccion.find_one({"isbns": isbn})
+        if not doc or doc['actualizado'] < datetime.now() - self.ttl_persistente:
+            return None
+        self.memoria.guardar(doc['_id'], doc['volumeInfo'])
+        return doc['_id'], doc['volumeInfo']
+
+    async def guardar(self, libro_id, info):
+        await self.guardar_varios({libro_id: info})
+
+    async def guardar_varios(self, volumenes):
+        if not volumenes:
+            return
+        ahora = datetime.now()
+        operaciones = []
+        for libro_id, info in volumenes.items():
+            self.memoria.guardar(libro_id, info)
+            operaciones.append(UpdateOne(
+                {"_id": libro_id},
+                {"$set": {"volumeInfo": info, "isbns": isbns_de(info), "actualizado": ahora}},
+                upsert=True
+            ))
+        with medir('db'):
+            await self.coleccion.bulk_write(operaciones, ordered=False)
+
+
+
+class CachePortadas:
+    # file_id de Telegram de la portada de cada id_google. Tras la primera
+    # subida Telegram ya tiene la imagen y reenviarla por file_id no la vuelve
+    # a descargar. Los file_id no caducan, asi que la coleccion no tiene TTL.
+    #
+    # Las portadas cuya URL Telegram no pudo descargar se recuerdan durante
+    # 'ttl_fallidas' para no volver a incluirlas (y tumbar el album) en cada
+    # busqueda.
+    def __init__(self, coleccion, max_elementos=5000, ttl=24 * 3600, ttl_fallidas=6 * 3600):
+        self.coleccion = coleccion
+        self.memoria = CacheLRU(max_elementos, ttl)
+        self.fallidas = CacheLRU(max_elementos, ttl_fallidas)
+
+    def fallida(self, libro_id):
+        return self.fallidas.obtener(libro_id) is not None
+
+    def marcar_fallida(self, libro_id):
+        self.fallidas.guardar(libro_id, True)
+
+    async def obtener_varios(self, libro_ids):
+        file_ids = {}
+        faltan = []
+        for libro_id in libro_ids:
+            file_id = self.memoria.obtener(libro_id)
+            if file_id is None:
+                faltan.append(libro_id)
+            else:
+                file_ids[libro_id] = file_id
+        if faltan:
+            with medir('db'):
+                docs = await self.coleccion.find({"_id": {"$in": faltan}}).to_list(None)
+            for doc in docs:
+                self.memoria.guardar(doc['_id'], doc['file_id'])
+                file_ids[doc['_id']] = doc['file_id']
+        return file_ids
+
+    async def guardar_varios(self, file_ids):
+        if not file_ids:
+            return
+        ahora = datetime.now()
+        for libro_id, file_id in file_ids.items():
+            self.memoria.guardar(libro_id, file_id)
+        with medir('db'):
+            await self.coleccion.bulk_write([
+                UpdateOne({"_id": libro_id}, {"$set": {"file_id": file_id, "actualizado": ahora}}, upsert=True)
+                for libro_id, file_id in file_ids.items()
+            ], ordered=False)
+
+    async def eliminar_varios(self, libro_ids):
+        for libro_id in libro_ids:
+            self.memoria.eliminar(libro_id)
+        with medir('db'):
+            await self.coleccion.delete_many({"_id": {"$in": list(libro_ids)}})
+
+def normalizar_consulta(texto):
+    texto = unicodedata.normalize('NFKD', texto.casefold())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', texto).strip()
+
+
+class CacheBusquedas:
+    # Resultados de busqueda por consulta normalizada + parametros. Las
+    # busquedas identicas que coinciden en el tiempo comparten una sola
+    # peticion a Google (single-flight).
+    #
+    # Pasado 'ttl' un resultado queda caducado pero se conserva hasta
+    # 'ttl_caducado': se responde con el al momento y se vuelve a pedir a
+    # Google en segundo plano (stale-while-revalidate). Asi una caida de
+    # Google no deja sin resultados a las busquedas ya conocidas.
+    def __init__(self, max_elementos=2000, ttl=600, ttl_caducado=24 * 3600):
+        self.memoria = CacheLRU(max_elementos, ttl_caducado)
+        self.ttl = ttl
+        self._en_vuelo = {}
+        self.aciertos = 0
+        self.fallos = 0
+        self.compartidas = 0
+        self.caducadas = 0
+
+    def clave(self, query, **params):
+        return (normalizar_consulta(query),) + tuple(sorted(params.items()))
+
+    async def obtener(self, query, cargar, **params):
+        # Devuelve (resultado, caducado)
+        clave = self.clave(query, **params)
+        guardado = self.memoria.obtener(clave)
+        if guardado is not None and time.monotonic() - guardado[1] < self.ttl:
+            self.aciertos += 1
+            return guardado[0], False
+
+        vuelo = self._en_vuelo.get(clave)
+        if vuelo is None:
+            self.fallos += 1
+            vuelo = {'tarea': asyncio.ensure_future(cargar(query, **params)), 'esperando': 0}
+            self._en_vuelo[clave] = vuelo
+            vuelo['tarea'].add_done_callback(lambda tarea: self._terminar(clave, vuelo, tarea))
+        else:
+            self.compartidas += 1
+
+        if guardado is not None:
+            # Nadie espera la tarea, asi que no se cancela: refresca la cache
+            self.caducadas += 1
+            return guardado[0], True
+
+        vuelo['esperando'] += 1
+        try:
+            return await asyncio.shield(vuelo['tarea']), False
+        finally:
+            vuelo['esperando'] -= 1
+            # Si ya nadie espera el resultado se cancela la peticion a Google
+            if vuelo['esperando'] == 0 and not vuelo['tarea'].done():
+                if self._en_vuelo.get(clave) is vuelo:
+                    del self._en_vuelo[clave]
+                vuelo['tarea'].cancel()
+
+    def _terminar(self, clave, vuelo, tarea):
+        if self._en_vuelo.get(clave) is vuelo:
+            del self._en_vuelo[clave]
+        if tarea.cancelled() or tarea.exception() is not None:
+            return
+        self.memoria.guardar(clave, (tarea.result(), time.monotonic()))
+
+    def metricas(self):
+        return {
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'compartidas': self.compartidas,
+            'caducadas': self.caducadas,
+            'en_vuelo': len(self._en_vuelo),
+            'elementos': len(self.memoria)
+        }
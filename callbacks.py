@@ -0,0 +1,139 @@
+import base64
+import re
+
+from bson import ObjectId
+
+
+# callback_data de los botones: "<version>|<accion>|<arg>|<arg>...". Los
+# codigos de accion son de un caracter y no se reutilizan; si cambia el
+# formato de los argumentos de alguna accion se sube VERSION y los botones de
+# mensajes antiguos se rechazan en lugar de interpretarse mal.
+VERSION = '1'
+SEPARADOR = '|'
+MAX_BYTES = 64
+
+
+class CallbackInvalido(ValueError):
+    pass
+
+
+def _google_id(valor):
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,40}', valor):
+        raise ValueError(valor)
+    return valor
+
+
+def _entero(valor):
+    if not re.fullmatch(r'\d{1,6}', valor):
+        raise ValueError(valor)
+    return int(valor)
+
+
+def _direccion(valor):
+    if valor not in ('ant', 'sig'):
+        raise ValueError(valor)
+    return valor
+
+
+def _object_id_a_texto(valor):
+    # 12 bytes en base64 url-safe: 16 caracteres en lugar de 24 en hexadecimal
+    return base64.urlsafe_b64encode(ObjectId(valor).binary).decode()
+
+
+def _object_id(valor):
+    if len(valor) != 16:
+        raise ValueError(valor)
+    return ObjectId(base64.urlsafe_b64decode(valor))
+
+
+# tipo -> (codificar, decodificar)
+TIPOS = {
+    'id': (str, _google_id),
+    'n': (str, _entero),
+    'dir': (str, _direccion),
+    'oid': (_object_id_a_texto, _object_id),
+}
+
+# accion -> (codigo, tipos de los argumentos)
+ACCIONES = {
+    'start': ('0', ()),
+    'buscar_libro': ('1', ()),
+    'mi_biblioteca': ('2', ()),
+    'lista_lectura': ('3', ()),
+    'estadisticas': ('4', ()),
+    'buscar_mis_libros': ('5', ()),
+    'calificar_libro': ('6', ()),
+    'pagina_biblioteca': ('7', ('n', 'dir', 'oid')),
+    'pagina_lista': ('8', ('n', 'dir', 'oid')),
+    'pagina_mis_libros': ('9', ('n',)),
+    'add_biblioteca': ('a', ('id',)),
+    'add_lista': ('b', ('id',)),
+    'detalles_biblioteca': ('c', ('id',)),
+    'eliminar_biblioteca': ('d', ('id',)),
+    'calificar_biblioteca': ('e', ('id',)),
+    'calificacion': ('f', ('id', 'n')),
+    'marcar_leido': ('g', ('id',)),
+    'eliminar_lista': ('h', ('id',)),
+    'recomendaciones': ('i', ()),
+}
+_POR_CODIGO = {codigo: (accion, tipos) for accion, (codigo, tipos) in ACCIONES.items()}
+
+
+def codificar(accion, *args):
+    codigo, tipos = ACCIONES[accion]
+    if len(args) != len(tipos):
+        raise ValueError(f"{accion} espera {len(tipos)} argumentos")
+    partes = [VERSION, codigo] + [TIPOS[tipo][0](arg) for tipo, arg in zip(tipos, args)]
+    datos = SEPARADOR.join(partes)
+    if len(datos.encode()) > MAX_BYTES:
+        raise ValueError(f"callback_data de {accion} supera {MAX_BYTES} bytes")
+    return datos
+
+
+def decodificar(datos):
+    # Devuelve (accion, [args ya convertidos]) o lanza CallbackInvalido
+    partes = (datos or '').split(SEPARADOR)
+    if len(partes) < 2 or partes[0] != VERSION or partes[1] not in _POR_CODIGO:
+        raise CallbackInvalido(datos)
+    accion, tipos = _POR_CODIGO[partes[1]]
+    valores = partes[2:]
+    if len(valores) != len(tipos):
+        raise CallbackInvalido(datos)
+    try:
+        return accion, [TIPOS[tipo][1](valor) for tipo, valor in zip(tipos, valores)]
+    except ValueError:
+        raise CallbackInvalido(datos)
+
+
+def patron(accion):
+    # Para los entry_points de ConversationHandler, que necesitan su propio handler
+    def coincide(datos):
+        try:
+            return decodificar(datos)[0] == accion
+        except CallbackInvalido:
+            return False
+    return coincide
+
+
+class Despachador:
+    # Un unico CallbackQueryHandler para todos los botones: el callback_data se
+    # valida y decodifica una vez y el handler se obtiene de un dict. Los
+    # argumentos llegan al handler en context.args.
+    def __init__(self):
+        self.handlers = {}
+
+    def registrar(self, accion, callback):
+        if accion not in ACCIONES:
+            raise ValueError(f"Acción desconocida: {accion}")
+        self.handlers[accion] = callback
+
+    async def __call__(self, update, context):
+        query = update.callback_query
+        try:
+            accion, args = decodificar(query.data)
+            callback = self.handlers[accion]
+        except (CallbackInvalido, KeyError):
+            await query.answer("Este botón ya no es válido. Usa /start para volver al menú.", show_alert=True)
+            return None
+        context.args = args
+        return await callback(update, context)
@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metricas import medido
+
+
+# Se pasan como rate_limit_args en las llamadas de context.bot; las respuestas
+# normales de los handlers usan PRIORIDAD_INTERACTIVA.
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_MASIVA = 1
+
+
+class CuboTokens:
+    # Token bucket con cola de espera por prioridad: cuando no hay tokens, los
+    # que esperan se atienden por (prioridad, orden de llegada).
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self._ultimo = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._esperando = []
+        self._orden = itertools.count()
+        self._temporizador = None
+
+    def _rellenar(self):
+        # Durante una pausa no se acumulan tokens
+        ahora = time.monotonic()
+        desde = max(self._ultimo, self._pausa_hasta)
+        if ahora > desde:
+            self.tokens = min(self.capacidad, self.tokens + (ahora - desde) * self.tasa)
+        self._ultimo = ahora
+        return ahora
+
+    @property
+    def inactivo(self):
+        self._rellenar()
+        return not self._esperando and self.tokens >= self.capacidad
+
+    async def adquirir(self, prioridad=PRIORIDAD_INTERACTIVA):
+        ahora = self._rellenar()
+        if not self._esperando and ahora >= self._pausa_hasta and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        futuro = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._esperando, (prioridad, next(self._orden), futuro))
+        self._programar()
+        await futuro
+
+    def pausar(self, segundos):
+        self._rellenar()
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+        self.tokens = min(self.tokens, 0)
+
+    def _programar(self):
+        if self._temporizador is not None or not self._esperando:
+            return
+        ahora = self._rellenar()
+        espera = max(self._pausa_hasta - ahora, (1 - self.tokens) / self.tasa, 0)
+        self._temporizador = asyncio.get_running_loop().call_later(espera, self._despachar)
+
+    def _despachar(self):
+        self._temporizador = None
+        ahora = self._rellenar()
+        while self._esperando and ahora >= self._pausa_hasta and self.tokens >= 1:
+            _, _, futuro = heapq.heappop(self._esperando)
+            if futuro.done():
+                continue
+            self.tokens -= 1
+            futuro.set_result(None)
+        self._programar()
+
+
+class LimitadorEnvios(BaseRateLimiter):
+    # Limita los envios a Telegram con un cubo global y uno por chat. Los
+    # mensajes de un mismo chat se envian de uno en uno y en orden; ante un
+    # RetryAfter se espera lo indicado (con backoff y jitter) y se reintenta.
+    def __init__(self, tasa_global=30, tasa_chat=1.0, rafaga_chat=3, tasa_grupo=20 / 60,
+                 max_reintentos=3):
+        self.cubo_global = CuboTokens(tasa_global, tasa_global)
+        self.tasa_chat = tasa_chat
+        self.rafaga_chat = rafaga_chat
+        self.tasa_grupo = tasa_grupo
+        self.max_reintentos = max_reintentos
+        self._chats = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) > 10000:
+                self._purgar()
+            es_grupo = isinstance(chat_id, str) or chat_id < 0
+            cubo = CuboTokens(self.tasa_grupo if es_grupo else self.tasa_chat, self.rafaga_chat)
+            chat = self._chats[chat_id] = (asyncio.Lock(), cubo)
+        return chat
+
+    def _purgar(self):
+        for chat_id, (cerrojo, cubo) in list(self._chats.items()):
+            if not cerrojo.locked() and cubo.inactivo:
+                del self._chats[chat_id]
+
+    @medido('telegram')
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        if isinstance(rate_limit_args, dict):
+            prioridad = rate_limit_args.get("prioridad", PRIORIDAD_INTERACTIVA)
+        else:
+            prioridad = rate_limit_args if rate_limit_args is not None else PRIORIDAD_INTERACTIVA
+
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        cerrojo, cubo_chat = self._chat(chat_id)
+        async with cerrojo:
+            for intento in range(self.max_reintentos + 1):
+                await cubo_chat.adquirir(prioridad)
+                await self.cubo_global.adquirir(prioridad)
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    if intento == self.max_reintentos:
+                        raise
+                    espera = e.retry_after
+                    if isinstance(espera, timedelta):
+                        espera = espera.total_seconds()
+                    espera = espera * (1 + 0.5 * intento) + random.uniform(0, 0.5)
+                    print(f"Límite de Telegram alcanzado ({endpoint}), reintentando en {espera:.1f}s")
+                    self.cubo_global.pausar(espera)
+                    cubo_chat.pausar(espera)
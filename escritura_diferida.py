@@ -0,0 +1,56 @@
+from cache import CacheLRU
+from volcado import VolcadoDiferido
+
+
+class EscrituraDiferida:
+    # Escrituras que no hace falta esperar: el alta/username de los usuarios
+    # en cada /start y las calificaciones. Se acumulan por clave (la ultima
+    # gana) y se vuelcan en bulk_write como mucho 'intervalo' segundos despues,
+    # o en cuanto hay 'max_pendientes' claves, y siempre al apagar el bot.
+    #
+    # Las calificaciones pendientes de un usuario se vuelcan antes de leer o
+    # borrar sus libros (vaciar_usuario), para que siempre vea las suyas.
+    def __init__(self, repositorio, intervalo=2.0, max_pendientes=1000):
+        self.repositorio = repositorio
+        self._usuarios_guardados = CacheLRU(max_elementos=50000, ttl=6 * 3600)
+        # usuarios: user_id -> username; calificaciones: (user_id, google_id) -> calificacion
+        self._volcado = VolcadoDiferido(
+            self._escribir, ('usuarios', 'calificaciones'), intervalo, max_pendientes
+        )
+
+    def registrar_usuario(self, user_id, username):
+        # Pulsar "Volver al inicio" no escribe nada si el username no cambio
+        if self._usuarios_guardados.obtener(user_id) == (username,):
+            return
+        self._volcado.anotar('usuarios', user_id, username)
+
+    def calificar(self, user_id, google_id, calificacion):
+        self._volcado.anotar('calificaciones', (user_id, google_id), calificacion)
+
+    def pendientes(self):
+        return len(self._volcado)
+
+    def metricas(self):
+        return {tipo: len(cambios) for tipo, cambios in self._volcado.pendientes.items()}
+
+    async def vaciar(self):
+        await self._volcado.vaciar()
+
+    async def vaciar_usuario(self, user_id):
+        # Sin nada pendiente ni un vaciado en curso (que podria llevar sus
+        # calificaciones) no hace falta esperar
+        pendientes = self._volcado.pendientes['calificaciones']
+        if not self._volcado.escribiendo and not any(clave[0] == user_id for clave in pendientes):
+            return
+        await self._volcado.vaciar(lambda tipo, clave: tipo == 'calificaciones' and clave[0] == user_id)
+
+    async def _escribir(self, cambios):
+        if cambios['usuarios']:
+            await self.repositorio.registrar_usuarios(cambios['usuarios'])
+            for user_id, username in cambios['usuarios'].items():
+                self._usuarios_guardados.guardar(user_id, (username,))
+        if cambios['calificaciones']:
+            await self.repositorio.calificar_varios(cambios['calificaciones'])
+
+    async def cerrar(self):
+        await self._volcado.cerrar()
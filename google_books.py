@@ -0,0 +1,283 @@
+import asyncio
+import contextvars
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import httpx
+
+from metricas import medir
+
+
+GOOGLE_BOOKS_URL = os.environ.get("GOOGLE_BOOKS_URL", "https://www.googleapis.com/books/v1/volumes")
+GOOGLE_CUOTA_MINUTO = int(os.environ.get("GOOGLE_CUOTA_MINUTO", "600"))
+# Parte de la cuota que las tareas masivas (importaciones) dejan a las busquedas de los usuarios
+RESERVA_INTERACTIVA = 0.25
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+# Peticiones de una tarea masiva: esperan a la cuota en lugar de fallar
+_masiva = contextvars.ContextVar('masiva', default=False)
+
+
+@contextmanager
+def peticiones_masivas():
+    token = _masiva.set(True)
+    try:
+        yield
+    finally:
+        _masiva.reset(token)
+
+
+class ErrorGoogleBooks(Exception):
+    pass
+
+
+class GoogleNoDisponible(ErrorGoogleBooks):
+    # Circuito abierto o cuota agotada: la peticion ni siquiera sale
+    pass
+
+
+class Circuito:
+    # Tras 'umbral' fallos seguidos deja de llamar a Google durante 'espera'
+    # segundos. Pasado ese tiempo deja salir una unica peticion de prueba: si
+    # sale bien se cierra; si falla vuelve a abrirse con el doble de espera.
+    def __init__(self, umbral=5, espera=15.0, espera_maxima=120.0):
+        self.umbral = umbral
+        self.espera_inicial = espera
+        self.espera_maxima = espera_maxima
+        self.espera = espera
+        self.fallos = 0
+        self.aperturas = 0
+        self._abierto_hasta = 0.0
+        self._probando = False
+
+    @property
+    def estado(self):
+        if self.fallos < self.umbral:
+            return 'cerrado'
+        if time.monotonic() < self._abierto_hasta or self._probando:
+            return 'abierto'
+        return 'semiabierto'
+
+    def permitir(self):
+        estado = self.estado
+        if estado == 'semiabierto':
+            self._probando = True
+        return estado != 'abierto'
+
+    def exito(self):
+        self.fallos = 0
+        self.espera = self.espera_inicial
+        self._probando = False
+
+    def fallo(self):
+        if self._probando:
+            self.espera = min(self.espera * 2, self.espera_maxima)
+        self._probando = False
+        self.fallos += 1
+        if self.fallos >= self.umbral:
+            if time.monotonic() >= self._abierto_hasta:
+                self.aperturas += 1
+            self._abierto_hasta = time.monotonic() + self.espera
+
+    def liberar(self):
+        # La peticion se cancelo sin respuesta: ni exito ni fallo
+        self._probando = False
+
+
+class Cuota:
+    # Presupuesto de peticiones por minuto (token bucket). Cuando se agota se
+    # falla en el acto en lugar de hacer esperar al usuario. Las peticiones
+    # masivas solo gastan por encima de la fraccion 'reserva' y esperan a que
+    # se recargue, asi una importacion no deja sin cuota a las busquedas.
+    def __init__(self, por_minuto, reserva=RESERVA_INTERACTIVA):
+        self.por_minuto = por_minuto
+        self.reserva = reserva
+        self.tokens = float(por_minuto)
+        self._ultimo = time.monotonic()
+
+    def disponibles(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.por_minuto, self.tokens + (ahora - self._ultimo) * self.por_minuto / 60)
+        self._ultimo = ahora
+        return self.tokens
+
+    def _minimo(self, masiva):
+        return 1 + (self.reserva * self.por_minuto if masiva else 0)
+
+    def consumir(self, masiva=False):
+        if not self.por_minuto:
+            return True
+        if self.disponibles() < self._minimo(masiva):
+            return False
+        self.tokens -= 1
+        return True
+
+    async def esperar(self):
+        # Para peticiones masivas: espera a que haya cuota por encima de la
+        # reserva y la consume. Devuelve los segundos esperados.
+        inicio = time.monotonic()
+        while not self.consumir(masiva=True):
+            await asyncio.sleep((self._minimo(True) - self.tokens) * 60 / self.por_minuto)
+        return time.monotonic() - inicio
+
+
+class ClienteGoogleBooks:
+    # Un unico cliente compartido por todos los handlers: reutiliza conexiones
+    # keep-alive y limita cuantas peticiones salen a la vez hacia Google.
+    #
+    # Todas las peticiones son GET, asi que los fallos transitorios (red,
+    # 429 y 5xx) se reintentan con espera exponencial y jitter, sin pasar de
+    # 'limite_total' segundos por llamada. El circuito y la cuota cortan en
+    # seco cuando Google esta caido o se gasto el presupuesto del minuto;
+    # dentro de peticiones_masivas() la cuota se espera en lugar de fallar.
+    # La cuota es por proceso. Cualquier error sale como ErrorGoogleBooks.
+    def __init__(self, url_base=GOOGLE_BOOKS_URL, max_conexiones=20, max_concurrentes=10,
+                 timeout=5.0, timeout_conexion=2.0, transporte=None, reintentos=2,
+                 espera_base=0.25, espera_maxima=2.0, limite_total=8.0, cuota_minuto=GOOGLE_CUOTA_MINUTO):
+        self.url_base = url_base.rstrip('/')
+        self.timeout = timeout
+        self.timeout_conexion = timeout_conexion
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.limite_total = limite_total
+        self.circuito = Circuito()
+        self.cuota = Cuota(cuota_minuto)
+        self.reintentos_hechos = 0
+        self.rechazadas = {'circuito': 0, 'cuota': 0}
+        self._semaforo = asyncio.Semaphore(max_concurrentes)
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_conexiones,
+                max_keepalive_connections=max_conexiones,
+                keepalive_expiry=30.0
+            ),
+            timeout=httpx.Timeout(timeout, connect=timeout_conexion),
+            transport=transporte
+        )
+
+    def disponible(self):
+        return self.circuito.estado != 'abierto' and (not self.cuota.por_minuto or self.cuota.disponibles() >= 1)
+
+    async def _get(self, url, params=None):
+        inicio = time.monotonic()
+        masiva = _masiva.get()
+        for intento in range(self.reintentos + 1):
+            if masiva and self.cuota.por_minuto:
+                # La espera por la cuota no cuenta para el limite de la llamada
+                inicio += await self.cuota.esperar()
+            with medir('google'):
+                async with self._semaforo:
+                    response, error = await self._intentar(
+                        url, params, self.limite_total - (time.monotonic() - inicio), con_cuota=masiva
+                    )
+            if error is None:
+                return self._json(response)
+
+            espera = self._espera(intento, response)
+            if intento == self.reintentos or time.monotonic() - inicio + espera >= self.limite_total:
+                break
+            self.reintentos_hechos += 1
+            await asyncio.sleep(espera)
+        raise ErrorGoogleBooks(f"Google Books no respondió: {error}") from error
+
+    async def _intentar(self, url, params, restante, con_cuota=False):
+        # Devuelve (response, None) o (response o None, error reintentable).
+        # con_cuota: la peticion ya consumio su parte de la cuota
+        if not self.circuito.permitir():
+            self.rechazadas['circuito'] += 1
+            raise GoogleNoDisponible("Google Books no está disponible (circuito abierto)")
+        if not con_cuota and not self.cuota.consumir():
+            self.circuito.liberar()
+            self.rechazadas['cuota'] += 1
+            raise GoogleNoDisponible("Se agotó la cuota de peticiones a Google Books de este minuto")
+
+        timeout = max(0.1, min(self.timeout, restante))
+        try:
+            response = await self._http.get(
+                url, params=params, timeout=httpx.Timeout(timeout, connect=min(self.timeout_conexion, timeout))
+            )
+        except httpx.TransportError as e:
+            self.circuito.fallo()
+            return None, e
+        except BaseException:
+            self.circuito.liberar()
+            raise
+
+        if response.status_code in ESTADOS_REINTENTABLES:
+            self.circuito.fallo()
+            return response, ErrorGoogleBooks(f"HTTP {response.status_code}")
+        self.circuito.exito()
+        return response, None
+
+    def _espera(self, intento, response):
+        # Full jitter: entre 0 y base * 2^intento. En un 429 se respeta
+        # Retry-After si lo trae.
+        espera = random.uniform(0, min(self.espera_maxima, self.espera_base * 2 ** intento))
+        if response is not None and response.headers.get('retry-after', '').isdigit():
+            espera = max(espera, float(response.headers['retry-after']))
+        return espera
+
+    def _json(self, response):
+        if response.is_error:
+            raise ErrorGoogleBooks(f"Google Books respondió HTTP {response.status_code}")
+        try:
+            return response.json()
+        except ValueError:
+            raise ErrorGoogleBooks("Google Books devolvió una respuesta que no es JSON")
+
+    def metricas(self):
+        return {
+            'circuito_abierto': int(self.circuito.estado == 'abierto'),
+            'fallos_seguidos': self.circuito.fallos,
+            'aperturas': self.circuito.aperturas,
+            'reintentos': self.reintentos_hechos,
+            'rechazadas_circuito': self.rechazadas['circuito'],
+            'rechazadas_cuota': self.rechazadas['cuota'],
+            'cuota_disponible': int(self.cuota.disponibles()) if self.cuota.por_minuto else -1,
+        }
+
+    async def buscar(self, query, max_resultados=3, idioma='es'):
+        params = {
+            'q': query,
+            'maxResults': max_resultados
+        }
+        if idioma:
+            params['langRestrict'] = idioma
+        data = await self._get(self.url_base, params=params)
+        return data.get('items', [])
+
+    async def obtener_volumen(self, libro_id):
+        return await self._get(f"{self.url_base}/{libro_id}")
+
+    async def cerrar(self):
+        await self._http.aclose()
+
+
+def portada_https(url):
+    # Google devuelve las miniaturas por http y con el efecto de pagina doblada
+    if not url:
+        return None
+    return url.replace('http://', 'https://', 1).replace('&edge=curl', '')
+
+
+def isbns_de(info):
+    return [id['identifier'] for id in info.get('industryIdentifiers', [])
+            if id['type'] in ('ISBN_10', 'ISBN_13')]
+
+
+def libro_desde_item(item):
+    info = item.get('volumeInfo', {})
+    return {
+        'titulo': info.get('title', 'Sin título'),
+        'autor': ', '.join(info.get('authors', ['Autor desconocido'])),
+        'descripcion': info.get('description', 'Sin descripción'),
+        'categorias': info.get('categories', []),
+        'imagen': portada_https(info.get('imageLinks', {}).get('thumbnail')),
+        'id_google': item['id'],
+        'fecha_publicacion': info.get('publishedDate', 'Fecha desconocida'),
+        'isbn': next((id['identifier'] for id in info.get('industryIdentifiers', [])
+                      if id['type'] == 'ISBN_13'), None)
+    }
@@ -0,0 +1,255 @@
+import asyncio
+import csv
+import io
+import re
+import time
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from envios import PRIORIDAD_MASIVA
+from google_books import ErrorGoogleBooks, peticiones_masivas
+
+
+MAX_TAMANO_ARCHIVO = 5 * 1024 * 1024
+MAX_FILAS = 5000
+TAMANO_LOTE = 50
+RESOLUCIONES_CONCURRENTES = 5
+INTERVALO_PROGRESO = 3.0
+
+# Columnas aceptadas: las del export de Goodreads y las que genera /exportar
+COLUMNAS = {
+    'titulo': ('titulo', 'título', 'title'),
+    'autor': ('autor', 'author'),
+    'isbn': ('isbn', 'isbn13'),
+    'google_id': ('google_id',),
+    'estante': ('estante', 'exclusive shelf', 'shelf'),
+    'calificacion': ('calificacion', 'calificación', 'rating'),
+    'calificacion_goodreads': ('my rating',),
+}
+ESTANTES_LISTA = {'lista', 'to-read', 'por leer'}
+ESTANTES_LEIDOS = {'leído', 'leido', 'read'}
+COLUMNAS_EXPORTACION = ('estante', 'titulo', 'autor', 'isbn', 'calificacion', 'google_id', 'fecha_agregado')
+
+
+def _valor(fila, candidatos):
+    for columna in candidatos:
+        valor = (fila.get(columna) or '').strip()
+        # Goodreads envuelve algunos campos en ="..." (y deja ="" si no hay valor)
+        if valor.startswith('="') and valor.endswith('"'):
+            valor = valor[2:-1].strip()
+        if valor:
+            return valor
+    return ''
+
+
+def leer_filas(texto):
+    # Normaliza cada fila del CSV a {titulo, autor, isbn, google_id, estante,
+    # leido, calificacion}. Las filas sin titulo, ISBN ni id se descartan.
+    lector = csv.DictReader(io.StringIO(texto))
+    if lector.fieldnames is None:
+        return []
+    lector.fieldnames = [nombre.strip().lower() for nombre in lector.fieldnames]
+
+    filas = []
+    for fila in lector:
+        datos = {campo: _valor(fila, candidatos) for campo, candidatos in COLUMNAS.items()}
+        datos['isbn'] = re.sub(r'[^0-9X]', '', datos['isbn'].upper())
+        if not (datos['titulo'] or datos['isbn'] or datos['google_id']):
+            continue
+
+        estante = datos['estante'].lower()
+        datos['estante'] = 'lista' if estante in ESTANTES_LISTA else 'biblioteca'
+        datos['leido'] = estante in ESTANTES_LEIDOS
+        # El bot califica de 1 a 10; Goodreads de 1 a 5 y usa 0 para "sin calificar"
+        goodreads = datos.pop('calificacion_goodreads')
+        try:
+            if goodreads:
+                calificacion = int(float(goodreads)) * 2
+            else:
+                calificacion = int(float(datos['calificacion']))
+        except ValueError:
+            calificacion = 0
+        datos['calificacion'] = calificacion if 1 <= calificacion <= 10 else None
+        filas.append(datos)
+    return filas
+
+
+class Importador:
+    # /importar recibe un CSV (propio o exportado de Goodreads), resuelve cada
+    # fila contra Google Books y guarda los libros por lotes; /exportar genera
+    # el CSV equivalente de la biblioteca y la lista de lectura.
+    def __init__(self, bot):
+        self.bot = bot
+        self._semaforo = asyncio.Semaphore(RESOLUCIONES_CONCURRENTES)
+        self._en_curso = set()
+
+    async def pedir_archivo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text(
+            "📥 Envíame un archivo CSV con tus libros.\n\n"
+            "Sirve el export de Goodreads (My Books → Import and export) o un CSV con las columnas "
+            "titulo, autor, isbn, estante (biblioteca, leído o lista) y calificacion."
+        )
+
+    async def importar(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        documento = update.message.document
+
+        if user_id in self._en_curso:
+            await update.message.reply_text("⏳ Ya hay una importación en curso. Espera a que termine.")
+            return
+        if documento.file_size and documento.file_size > MAX_TAMANO_ARCHIVO:
+            await update.message.reply_text("⚠️ El archivo es demasiado grande (máximo 5 MB).")
+            return
+
+        archivo = await documento.get_file()
+        contenido = await archivo.download_as_bytearray()
+        try:
+            filas = leer_filas(bytes(contenido).decode('utf-8-sig'))
+        except (UnicodeDecodeError, csv.Error):
+            await update.message.reply_text("⚠️ No pude leer el archivo. ¿Es un CSV en UTF-8?")
+            return
+        if not filas:
+            await update.message.reply_text("⚠️ No encontré libros en el archivo.")
+            return
+
+        mensaje = await update.message.reply_text(f"📥 Importando {min(len(filas), MAX_FILAS)} libros...")
+        # Se procesa en segundo plano para no frenar los updates del resto de usuarios
+        self._en_curso.add(user_id)
+        context.application.create_task(self._importar(user_id, filas[:MAX_FILAS], mensaje), update=update)
+
+    async def _importar(self, user_id, filas, mensaje):
+        resumen = {'biblioteca': 0, 'lista': 0, 'repetidos': 0, 'sin_resolver': []}
+        ultimo_aviso = time.monotonic()
+        try:
+            for inicio in range(0, len(filas), TAMANO_LOTE):
+                lote = filas[inicio:inicio + TAMANO_LOTE]
+                # Si se acaba la cuota de Google las filas esperan a que se
+                # recargue, sin gastar la parte reservada a las busquedas
+                with peticiones_masivas():
+                    volumenes = await asyncio.gather(*(self._resolver(fila) for fila in lote))
+
+                libros = {'biblioteca': [], 'lista': []}
+                for fila, volumen in zip(lote, volumenes):
+                    if volumen is None:
+                        resumen['sin_resolver'].append(fila['titulo'] or fila['isbn'] or fila['google_id'])
+                    else:
+                        libros[fila['estante']].append(self._documento(user_id, fila, *volumen))
+
+                for estante, coleccion in (('biblioteca', 'biblioteca_personal'), ('lista', 'lista_lectura')):
+                    nuevos = await self.bot.repositorio.importar_libros(coleccion, libros[estante])
+                    resumen[estante] += nuevos
+                    resumen['repetidos'] += len(libros[estante]) - nuevos
+
+                procesadas = inicio + len(lote)
+                if procesadas < len(filas) and time.monotonic() - ultimo_aviso >= INTERVALO_PROGRESO:
+                    ultimo_aviso = time.monotonic()
+                    await mensaje.edit_text(
+                        f"📥 Importando... {procesadas}/{len(filas)} filas procesadas.",
+                        rate_limit_args=PRIORIDAD_MASIVA
+                    )
+
+            await self.bot.escrituras.vaciar_usuario(user_id)
+            await self.bot.repositorio.reconstruir_estadisticas(user_id)
+        except Exception as e:
+            print(f"Error al importar libros de {user_id}: {e}")
+            await mensaje.edit_text("⚠️ La importación se interrumpió por un error. Los libros ya guardados se conservan.")
+            return
+        finally:
+            self._en_curso.discard(user_id)
+
+        texto = (
+            "✅ Importación terminada.\n\n"
+            f"📖 Añadidos a tu biblioteca: {resumen['biblioteca']}\n"
+            f"📝 Añadidos a tu lista de lectura: {resumen['lista']}\n"
+            f"🔁 Ya los tenías: {resumen['repetidos']}\n"
+            f"❓ Sin encontrar: {len(resumen['sin_resolver'])}"
+        )
+        if resumen['sin_resolver']:
+            texto += "\n\n" + "\n".join(f"• {titulo}" for titulo in resumen['sin_resolver'][:10])
+            if len(resumen['sin_resolver']) > 10:
+                texto += "\n..."
+        await mensaje.edit_text(texto)
+
+    async def _resolver(self, fila):
+        # Devuelve (id_google, volumeInfo) o None. Primero se prueba con los
+        # volumenes ya conocidos y las busquedas en cache; Google solo se
+        # consulta para lo que falte.
+        async with self._semaforo:
+            try:
+                if fila['google_id']:
+                    return fila['google_id'], await self.bot.obtener_info_volumen(fila['google_id'])
+                if fila['isbn']:
+                    conocido = await self.bot.volumenes.buscar_isbn(fila['isbn'])
+                    if conocido:
+                        return conocido
+                    items = await self._buscar(f"isbn:{fila['isbn']}")
+                    if items:
+                        return items[0]['id'], items[0].get('volumeInfo', {})
+                if fila['titulo']:
+                    consulta = f"intitle:{fila['titulo']}"
+                    if fila['autor']:
+                        consulta += f" inauthor:{fila['autor']}"
+                    items = await self._buscar(consulta)
+                    if items:
+                        return items[0]['id'], items[0].get('volumeInfo', {})
+            except ErrorGoogleBooks as e:
+                print(f"Error al resolver '{fila['titulo'] or fila['isbn']}' en Google Books: {e}")
+        return None
+
+    async def _buscar(self, consulta):
+        items, _ = await self.bot.busquedas.obtener(consulta, self.bot._buscar_en_google, max_resultados=1, idioma=None)
+        return items
+
+    def _documento(self, user_id, fila, libro_id, info):
+        libro = {
+            "user_id": user_id,
+            "google_id": libro_id,
+            "titulo": info.get('title', fila['titulo']),
+            "autor": ', '.join(info.get('authors', [])) or fila['autor'],
+            "categorias": info.get('categories', []),
+            "fecha_agregado": datetime.now(),
+        }
+        if fila['estante'] == 'biblioteca':
+            if fila['leido']:
+                libro["estado"] = "leído"
+            if fila['calificacion']:
+                libro["rating"] = fila['calificacion']
+                libro["fecha_calificacion"] = libro["fecha_agregado"]
+        return libro
+
+    async def exportar(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        await self.bot.escrituras.vaciar_usuario(user_id)
+
+        # PTB sube el documento desde memoria, asi que el CSV se genera
+        # directamente en un buffer de bytes
+        archivo = io.BytesIO()
+        texto = io.TextIOWrapper(archivo, encoding='utf-8', newline='')
+        escritor = csv.writer(texto)
+        escritor.writerow(COLUMNAS_EXPORTACION)
+        total = 0
+        async for estante, libro in self.bot.repositorio.iterar_libros(user_id):
+            if estante == 'biblioteca' and libro.get('estado') == 'leído':
+                estante = 'leído'
+            isbns = libro['isbns'][0] if libro.get('isbns') else []
+            isbn = next((isbn for isbn in isbns if len(isbn) == 13), isbns[0] if isbns else '')
+            fecha = libro.get('fecha_agregado')
+            escritor.writerow([
+                estante, libro.get('titulo', ''), libro.get('autor', ''), isbn, libro.get('rating', ''),
+                libro['google_id'], fecha.strftime('%Y-%m-%d') if fecha else ''
+            ])
+            total += 1
+        texto.flush()
+        texto.detach()
+
+        if not total:
+            await update.message.reply_text("📚 Aún no tienes libros para exportar.")
+            return
+
+        await update.message.reply_document(
+            document=archivo.getvalue(),
+            filename=f"capitulo_cero_{datetime.now():%Y%m%d}.csv",
+            caption=f"📤 Tus {total} libros. Puedes volver a importarlos con /importar."
+        )
@@ -0,0 +1,175 @@
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from servidor_http import servir
+
+
+METRICAS_PUERTO = int(os.environ.get("METRICAS_PUERTO", "0"))
+UMBRAL_LENTO_MS = float(os.environ.get("UMBRAL_LENTO_MS", "0"))
+
+COMPONENTES = ('google', 'db', 'telegram')
+CUBETAS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Tiempo acumulado por componente durante el update que se esta procesando
+_desglose = contextvars.ContextVar('desglose', default=None)
+
+
+@contextmanager
+def medir(componente):
+    # Las llamadas anidadas o solapadas del mismo componente se cuentan una vez
+    desglose = _desglose.get()
+    if desglose is None or componente in desglose['activos']:
+        yield
+        return
+    desglose['activos'].add(componente)
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        desglose['activos'].discard(componente)
+        desglose[componente] += time.perf_counter() - inicio
+
+
+def medido(componente):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def envoltura(*args, **kwargs):
+            with medir(componente):
+                return await funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def _etiquetas(nombres, valores):
+    pares = ','.join(f'{nombre}="{str(valor).replace(chr(34), chr(39))}"' for nombre, valor in zip(nombres, valores))
+    return '{' + pares + '}' if pares else ''
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas, cubetas=CUBETAS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.cubetas = cubetas
+        self.series = {}
+
+    def observar(self, valores, valor):
+        serie = self.series.get(valores)
+        if serie is None:
+            serie = self.series[valores] = {'cubetas': [0] * len(self.cubetas), 'suma': 0.0, 'total': 0}
+        for indice, limite in enumerate(self.cubetas):
+            if valor <= limite:
+                serie['cubetas'][indice] += 1
+                break
+        serie['suma'] += valor
+        serie['total'] += 1
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        for valores, serie in sorted(self.series.items()):
+            acumulado = 0
+            for limite, cantidad in zip(self.cubetas, serie['cubetas']):
+                acumulado += cantidad
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas + ('le',), valores + (limite,))} {acumulado}")
+            lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas + ('le',), valores + ('+Inf',))} {serie['total']}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, valores)} {serie['suma']:.6f}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, valores)} {serie['total']}")
+        return lineas
+
+
+class Metricas:
+    # Latencia por handler con el desglose Google Books / MongoDB / Bot API,
+    # servida en formato Prometheus en http://127.0.0.1:<puerto>/metrics.
+    def __init__(self, puerto=METRICAS_PUERTO, umbral_lento_ms=UMBRAL_LENTO_MS):
+        self.puerto = puerto
+        self.umbral_lento = umbral_lento_ms / 1000
+        self.latencia = Histograma(
+            'capitulo_handler_segundos', 'Latencia total de cada handler.', ('handler',)
+        )
+        self.componentes = Histograma(
+            'capitulo_handler_componente_segundos',
+            'Tiempo de cada handler en Google Books, MongoDB, la Bot API de Telegram y el resto.',
+            ('handler', 'componente')
+        )
+        self.errores = {}
+        self.indicadores = {}
+        self._servidor = None
+
+    def instrumentar(self, callback, patron=None):
+        nombre = callback.__name__
+
+        @functools.wraps(callback)
+        async def envoltura(update, context):
+            desglose = dict.fromkeys(COMPONENTES, 0.0)
+            desglose['activos'] = set()
+            token = _desglose.set(desglose)
+            inicio = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.errores[nombre] = self.errores.get(nombre, 0) + 1
+                raise
+            finally:
+                _desglose.reset(token)
+                total = time.perf_counter() - inicio
+                self._registrar(nombre, patron, update, total, desglose)
+
+        return envoltura
+
+    def _registrar(self, nombre, patron, update, total, desglose):
+        self.latencia.observar((nombre,), total)
+        otros = total
+        for componente in COMPONENTES:
+            self.componentes.observar((nombre, componente), desglose[componente])
+            otros -= desglose[componente]
+        self.componentes.observar((nombre, 'otros'), max(otros, 0.0))
+
+        if self.umbral_lento and total >= self.umbral_lento:
+            query = getattr(update, 'callback_query', None)
+            datos = query.data if query else None
+            partes = ' '.join(f"{componente}={desglose[componente] * 1000:.0f}ms" for componente in COMPONENTES)
+            print(f"Update lento: {nombre} patrón={patron} datos={datos} total={total * 1000:.0f}ms "
+                  f"{partes} otros={max(otros, 0.0) * 1000:.0f}ms")
+
+    def registrar_indicador(self, nombre, ayuda, funcion, contadores=()):
+        # funcion() devuelve un numero o un dict {valor_etiqueta: numero}. Las
+        # claves de 'contadores' solo crecen: se exportan como counter en
+        # <nombre>_total, para que rate() detecte los reinicios del proceso.
+        self.indicadores[nombre] = (ayuda, funcion, contadores)
+
+    def exportar(self):
+        lineas = self.latencia.exportar() + self.componentes.exportar()
+        lineas += ["# HELP capitulo_handler_errores_total Excepciones no controladas por handler.",
+                   "# TYPE capitulo_handler_errores_total counter"]
+        lineas += [f'capitulo_handler_errores_total{{handler="{nombre}"}} {cantidad}'
+                   for nombre, cantidad in sorted(self.errores.items())]
+        for nombre, (ayuda, funcion, contadores) in self.indicadores.items():
+            valor = funcion()
+            if not isinstance(valor, dict):
+                lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} gauge", f"{nombre} {valor}"]
+                continue
+            for familia, tipo, es_contador in ((nombre, 'gauge', False), (f"{nombre}_total", 'counter', True)):
+                series = [(clave, cantidad) for clave, cantidad in valor.items() if (clave in contadores) == es_contador]
+                if series:
+                    lineas += [f"# HELP {familia} {ayuda}", f"# TYPE {familia} {tipo}"]
+                    lineas += [f'{familia}{{tipo="{clave}"}} {cantidad}' for clave, cantidad in series]
+        return '\n'.join(lineas) + '\n'
+
+    async def iniciar_servidor(self, host='127.0.0.1'):
+        if not self.puerto:
+            return
+
+        async def atender(peticion):
+            if peticion.ruta != '/metrics':
+                return 404, 'text/plain', b'no encontrado'
+            return 200, 'text/plain; version=0.0.4', self.exportar().encode()
+
+        self._servidor = await servir(atender, host, self.puerto)
+        print(f"Métricas en http://{host}:{self.puerto}/metrics")
+
+    def cerrar(self):
+        if self._servidor is not None:
+            self._servidor.close()
@@ -0,0 +1,115 @@
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, PersistenceInput
+
+from volcado import VolcadoDiferido
+
+
+class PersistenciaMongo(BasePersistence):
+    # Guarda user_data y el estado de los ConversationHandler en Mongo.
+    #
+    # - Los datos de cada usuario se leen de Mongo la primera vez que este
+    #   proceso ve al usuario; a partir de ahi se sirven desde memoria.
+    # - Las escrituras se acumulan y se vuelcan en un unico bulk_write como
+    #   mucho 'intervalo_vaciado' segundos despues del cambio, y siempre al
+    #   apagar el bot.
+    def __init__(self, db, intervalo_vaciado=1.0, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.datos_usuario = db.datos_usuario
+        self.conversaciones = db.conversaciones
+
+        self._usuarios_cargados = set()
+        # usuarios: user_id -> datos (None = borrar); conversaciones: (nombre, clave) -> estado
+        self._volcado = VolcadoDiferido(
+            self._escribir, ('usuarios', 'conversaciones'), intervalo_vaciado,
+            descripcion="el guardado del estado de las conversaciones"
+        )
+
+    # Lectura
+
+    async def get_user_data(self):
+        # Se cargan bajo demanda en refresh_user_data
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conversaciones = {}
+        async for doc in self.conversaciones.find({"nombre": name}):
+            conversaciones[tuple(doc["clave"])] = doc["estado"]
+        return conversaciones
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._usuarios_cargados:
+            return
+        self._usuarios_cargados.add(user_id)
+        doc = await self.datos_usuario.find_one({"_id": user_id})
+        if doc:
+            for clave, valor in doc["datos"].items():
+                user_data.setdefault(clave, valor)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # Escritura
+
+    async def update_user_data(self, user_id, data):
+        self._usuarios_cargados.add(user_id)
+        self._volcado.anotar('usuarios', user_id, dict(data))
+
+    async def drop_user_data(self, user_id):
+        self._usuarios_cargados.discard(user_id)
+        self._volcado.anotar('usuarios', user_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        self._volcado.anotar('conversaciones', (name, tuple(key)), new_state)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def _escribir(self, cambios):
+        operaciones_usuarios = [
+            DeleteOne({"_id": user_id}) if datos is None
+            else UpdateOne({"_id": user_id}, {"$set": {"datos": datos}}, upsert=True)
+            for user_id, datos in cambios['usuarios'].items()
+        ]
+        operaciones_conversaciones = []
+        for (nombre, clave), estado in cambios['conversaciones'].items():
+            _id = f"{nombre}:{':'.join(map(str, clave))}"
+            if estado is None:
+                operaciones_conversaciones.append(DeleteOne({"_id": _id}))
+            else:
+                operaciones_conversaciones.append(UpdateOne(
+                    {"_id": _id},
+                    {"$set": {"nombre": nombre, "clave": list(clave), "estado": estado}},
+                    upsert=True
+                ))
+
+        if operaciones_usuarios:
+            await self.datos_usuario.bulk_write(operaciones_usuarios, ordered=False)
+        if operaciones_conversaciones:
+            await self.conversaciones.bulk_write(operaciones_conversaciones, ordered=False)
+
+    async def flush(self):
+        await self._volcado.cerrar()
@@ -0,0 +1,190 @@
+import asyncio
+import os
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+UPDATES_CONCURRENTES = int(os.environ.get("UPDATES_CONCURRENTES", "32"))
+MAX_COLA_USUARIO = int(os.environ.get("MAX_COLA_USUARIO", "20"))
+MAX_PENDIENTES = 1000
+
+
+def clave_de_update(update):
+    # Los updates de un mismo usuario (o chat, si no hay usuario) comparten cola
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class _ColaUsuario:
+    __slots__ = ('updates', 'esperando', 'programada')
+
+    def __init__(self):
+        self.updates = deque()
+        self.esperando = deque()
+        self.programada = False
+
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    # Procesa updates de usuarios distintos en paralelo y los de un mismo
+    # usuario de uno en uno y en orden de llegada, para que flujos como
+    # calificar o marcar como leido no se pisen.
+    #
+    # - Cada usuario con updates pendientes tiene su cola; la cola esta en
+    #   'listos' (o la tiene un trabajador) mientras no se vacie, asi que
+    #   nunca hay dos updates del mismo usuario en marcha a la vez.
+    # - 'trabajadores' tareas fijas atienden las colas por turnos: un update
+    #   por turno, y el usuario vuelve al final si le quedan mas. Un usuario
+    #   con una busqueda lenta solo ocupa un trabajador.
+    # - Contrapresion: si un usuario acumula 'max_cola_usuario' updates, los
+    #   nuevos esperan su turno, en orden, a que se libere sitio en su cola.
+    #   Solo entonces toman hueco en el semaforo de PTB, que limita a
+    #   'max_pendientes' los updates admitidos (en cola o en marcha) entre
+    #   todos los usuarios. No se pierde ningun update.
+    # - En modo webhook el worker deja de leer de la cola del proceso frontal
+    #   mientras el procesador esta lleno (esperar_capacidad). En polling el
+    #   Updater de PTB sigue pidiendo updates a Telegram y los que no caben
+    #   esperan como tareas de PTB en el semaforo.
+    def __init__(self, trabajadores=UPDATES_CONCURRENTES, max_cola_usuario=MAX_COLA_USUARIO,
+                 max_pendientes=MAX_PENDIENTES):
+        super().__init__(max_pendientes)
+        self.trabajadores = trabajadores
+        self.max_cola_usuario = max_cola_usuario
+        self.max_pendientes = max_pendientes
+
+        self._colas = {}
+        self._listos = asyncio.Queue()
+        self._tareas = []
+        self._en_proceso = 0
+        self._pendientes = 0
+        self._esperando = 0
+        self._con_capacidad = asyncio.Event()
+        self._con_capacidad.set()
+
+    async def initialize(self):
+        if not self._tareas:
+            self._tareas = [asyncio.create_task(self._trabajar()) for _ in range(self.trabajadores)]
+
+    async def shutdown(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+        for cola in self._colas.values():
+            for coroutine, futuro in cola.updates:
+                coroutine.close()
+                futuro.cancel()
+        self._colas.clear()
+
+    async def process_update(self, update, coroutine):
+        # PTB toma el hueco del semaforo global y luego llama a
+        # do_process_update. Aqui el orden es el inverso: primero el turno en
+        # la cola del usuario y despues el hueco global, para que los updates
+        # de un usuario que inunda el bot esperen sin ocupar los huecos de los
+        # demas (como mucho tiene 'max_cola_usuario' admitidos).
+        clave = clave_de_update(update)
+        if clave is None:
+            # Sin usuario ni chat no hay orden que respetar: cola propia
+            clave = object()
+
+        cola = self._colas.get(clave)
+        if cola is None:
+            cola = self._colas[clave] = _ColaUsuario()
+
+        # Todos pasan por la fila del usuario; el primero sigue en ella hasta
+        # entrar en la cola, asi nadie le adelanta mientras espera el semaforo
+        turno = asyncio.get_running_loop().create_future()
+        cola.esperando.append(turno)
+        self._despertar(cola)
+        try:
+            if not turno.done():
+                self._esperando += 1
+                try:
+                    await turno
+                finally:
+                    self._esperando -= 1
+            async with self._semaphore:
+                cola.esperando.remove(turno)
+                await self.do_process_update(update, coroutine, clave)
+        except BaseException:
+            if turno in cola.esperando:
+                # Cancelado antes de entrar en la cola: cede el turno al siguiente
+                coroutine.close()
+                cola.esperando.remove(turno)
+                self._despertar(cola)
+                if not (cola.updates or cola.esperando or cola.programada):
+                    self._colas.pop(clave, None)
+            raise
+
+    async def do_process_update(self, update, coroutine, clave=None):
+        # Solo se llama desde process_update, con el turno y el hueco ya concedidos
+        cola = self._colas[clave]
+        futuro = asyncio.get_running_loop().create_future()
+        cola.updates.append((coroutine, futuro))
+        if not cola.programada:
+            cola.programada = True
+            self._listos.put_nowait(clave)
+        self._despertar(cola)
+        self._cambiar_pendientes(1)
+        try:
+            await futuro
+        finally:
+            self._cambiar_pendientes(-1)
+
+    def _despertar(self, cola):
+        # Da paso al primero que espera si queda sitio en la cola del usuario
+        if cola.esperando and len(cola.updates) < self.max_cola_usuario and not cola.esperando[0].done():
+            cola.esperando[0].set_result(None)
+
+    def _cambiar_pendientes(self, cambio):
+        self._pendientes += cambio
+        if self._pendientes >= self.max_pendientes:
+            self._con_capacidad.clear()
+        else:
+            self._con_capacidad.set()
+
+    async def esperar_capacidad(self):
+        # Para quien mete updates en la Application (el worker del webhook):
+        # deja de leer mientras el procesador esta lleno
+        await self._con_capacidad.wait()
+
+    async def _trabajar(self):
+        while True:
+            clave = await self._listos.get()
+            cola = self._colas[clave]
+            coroutine, futuro = cola.updates.popleft()
+            self._despertar(cola)
+            self._en_proceso += 1
+            try:
+                resultado = await coroutine
+            except asyncio.CancelledError:
+                futuro.cancel()
+                raise
+            except Exception as e:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            else:
+                if not futuro.done():
+                    futuro.set_result(resultado)
+            finally:
+                self._en_proceso -= 1
+                if cola.updates:
+                    self._listos.put_nowait(clave)
+                else:
+                    cola.programada = False
+                    if not cola.esperando:
+                        del self._colas[clave]
+
+    def metricas(self):
+        return {
+            'pendientes': self._pendientes,
+            'en_proceso': self._en_proceso,
+            'usuarios_en_cola': len(self._colas),
+            'max_cola_usuario': max((len(cola.updates) for cola in self._colas.values()), default=0),
+            'esperando_cola_usuario': self._esperando,
+        }
@@ -0,0 +1,240 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    # Sin NumPy/SciPy no se calculan vecinos; las recomendaciones ya
+    # guardadas en Mongo se siguen pudiendo consultar.
+    np = None
+    sparse = None
+
+
+RECOMENDACIONES_INTERVALO = int(os.environ.get("RECOMENDACIONES_INTERVALO", "600"))
+K_VECINOS = 20
+ENCOGIMIENTO = 10.0
+TAMANO_BLOQUE = 1000
+RECONSTRUCCION = 24 * 3600
+
+
+def disponible():
+    return np is not None
+
+
+def vecinos_similares(matriz, columnas, k=K_VECINOS, encogimiento=ENCOGIMIENTO, tamano_bloque=TAMANO_BLOQUE):
+    # Coseno ajustado entre libros: a cada calificacion se le resta la media
+    # del usuario y se compara cada columna de 'columnas' con todas las demas.
+    # La similitud se encoge con n / (n + encogimiento), siendo n el numero de
+    # usuarios que calificaron ambos libros, para no fiarse de un solo lector.
+    # Genera (columna, columnas_vecinas, similitudes) con los k mejores > 0.
+    matriz = matriz.tocsr().astype(np.float32)
+    conteos = np.diff(matriz.indptr)
+    medias = np.asarray(matriz.sum(axis=1)).ravel() / np.maximum(conteos, 1)
+    centrada = matriz.copy()
+    centrada.data -= np.repeat(medias, conteos).astype(np.float32)
+
+    normas = np.sqrt(np.asarray(centrada.multiply(centrada).sum(axis=0)).ravel())
+    inversas = np.divide(1.0, normas, out=np.zeros_like(normas), where=normas > 0)
+    centrada = (centrada @ sparse.diags(inversas)).tocsc()
+    binaria = matriz.copy()
+    binaria.data[:] = 1.0
+    binaria = binaria.tocsc()
+    centrada_t = centrada.T.tocsr()
+    binaria_t = binaria.T.tocsr()
+
+    columnas = np.asarray(columnas)
+    for inicio in range(0, len(columnas), tamano_bloque):
+        bloque = columnas[inicio:inicio + tamano_bloque]
+        # libros x bloque; con el mismo patron en ambos productos
+        productos = (centrada_t @ centrada[:, bloque]).tocsc()
+        comunes = (binaria_t @ binaria[:, bloque]).tocsc()
+        comunes.data = comunes.data / (comunes.data + encogimiento)
+        similitudes = productos.multiply(comunes).tocsc()
+
+        for posicion, columna in enumerate(bloque):
+            desde, hasta = similitudes.indptr[posicion], similitudes.indptr[posicion + 1]
+            valores = similitudes.data[desde:hasta]
+            filas = similitudes.indices[desde:hasta]
+            validos = (valores > 0) & (filas != columna)
+            valores, filas = valores[validos], filas[validos]
+            if len(valores) > k:
+                mejores = np.argpartition(-valores, k)[:k]
+                valores, filas = valores[mejores], filas[mejores]
+            orden = np.argsort(-valores)
+            yield columna, filas[orden], valores[orden]
+
+
+class MatrizValoraciones:
+    # Matriz dispersa usuario x libro que se mantiene en memoria entre
+    # ejecuciones: cada actualizacion solo aplica las calificaciones nuevas.
+    def __init__(self):
+        self.filas = {}
+        self.columnas = {}
+        self.google_ids = []
+        self.matriz = sparse.csr_matrix((0, 0), dtype=np.float32)
+
+    def _indice(self, indices, clave, lista=None):
+        indice = indices.get(clave)
+        if indice is None:
+            indice = indices[clave] = len(indices)
+            if lista is not None:
+                lista.append(clave)
+        return indice
+
+    def indexar(self, valoraciones):
+        # valoraciones: [(user_id, google_id, calificacion)] -> arrays de
+        # (filas, columnas, valores), dando indice a los usuarios y libros nuevos
+        filas = np.fromiter((self._indice(self.filas, v[0]) for v in valoraciones), dtype=np.int64, count=len(valoraciones))
+        columnas = np.fromiter((self._indice(self.columnas, v[1], self.google_ids) for v in valoraciones),
+                               dtype=np.int64, count=len(valoraciones))
+        valores = np.fromiter((v[2] for v in valoraciones), dtype=np.float32, count=len(valoraciones))
+        return filas, columnas, valores
+
+    def aplicar(self, valoraciones):
+        return self.aplicar_indices(*self.indexar(valoraciones))
+
+    def aplicar_indices(self, filas, columnas, valores):
+        # Devuelve las columnas de los libros calificados, que son las que se
+        # recalculan. Es una aproximacion: una calificacion nueva tambien
+        # mueve la media del usuario y la similitud de otros pares, pero
+        # recalcular todos los libros de los usuarios activos seria casi una
+        # reconstruccion; eso queda para la reconstruccion diaria.
+        if not len(filas):
+            return np.array([], dtype=np.int64)
+        forma = (len(self.filas), len(self.columnas))
+        self.matriz.resize(forma)
+        # sum_duplicates sumaria dos calificaciones del mismo libro: se deja la ultima
+        _, ultimas = np.unique((filas * forma[1] + columnas)[::-1], return_index=True)
+        ultimas = len(filas) - 1 - ultimas
+        delta = sparse.csr_matrix((valores[ultimas], (filas[ultimas], columnas[ultimas])), shape=forma)
+        mascara = delta.copy()
+        mascara.data[:] = 1.0
+        self.matriz = (self.matriz - self.matriz.multiply(mascara) + delta).tocsr()
+        self.matriz.eliminate_zeros()
+
+        return np.unique(columnas)
+
+
+class Recomendador:
+    # Tarea en segundo plano que mantiene en la coleccion 'recomendaciones'
+    # los K libros mas parecidos a cada libro calificado. Pedir
+    # recomendaciones es una unica consulta por _id sobre esa coleccion.
+    #
+    # Cada ejecucion lee solo las calificaciones posteriores a la anterior y
+    # recalcula los libros afectados. Las eliminaciones no dejan rastro, asi
+    # que una vez al dia se reconstruye todo desde cero.
+    #
+    # Las calificaciones llegan por lotes y se guardan como arrays; los
+    # titulos solo se piden para los libros que acaban siendo vecinos. Todo el
+    # calculo va al executor: con millones de calificaciones bloquearia el
+    # bucle de eventos varios segundos.
+    def __init__(self, repositorio, intervalo=RECOMENDACIONES_INTERVALO, k=K_VECINOS):
+        self.repositorio = repositorio
+        self.intervalo = intervalo
+        self.k = k
+        self.activo = disponible() and intervalo > 0
+        self._valoraciones = None
+        self._titulos = {}
+        self._desde = None
+        self._ultima_reconstruccion = 0.0
+        self._tarea = None
+
+    def iniciar(self):
+        if self.activo and self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def cerrar(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    async def _bucle(self):
+        while True:
+            try:
+                await self.actualizar()
+            except Exception as e:
+                print(f"Error al actualizar las recomendaciones: {e}")
+            await asyncio.sleep(self.intervalo)
+
+    async def actualizar(self):
+        completa = self._valoraciones is None or time.monotonic() - self._ultima_reconstruccion > RECONSTRUCCION
+        # Margen para no perder calificaciones escritas mientras se leia
+        inicio = datetime.now() - timedelta(seconds=5)
+        if completa:
+            matriz = MatrizValoraciones()
+            self._titulos = {}
+        else:
+            matriz = self._valoraciones
+
+        loop = asyncio.get_running_loop()
+        indices = []
+        async for lote in self.repositorio.valoraciones(None if completa else self._desde):
+            indices.append(await loop.run_in_executor(None, matriz.indexar, lote))
+        columnas, vecinos = await loop.run_in_executor(None, self._calcular, matriz, indices)
+        del indices
+        if len(columnas):
+            faltan = await loop.run_in_executor(None, self._sin_titulo, matriz, vecinos)
+            self._titulos.update(await self.repositorio.titulos(faltan))
+            documentos = await loop.run_in_executor(None, self._documentos, matriz, vecinos)
+            await self.repositorio.guardar_recomendaciones(documentos)
+            print(f"Recomendaciones actualizadas: {len(columnas)} libros "
+                  f"({'reconstrucción completa' if completa else 'incremental'})")
+        if completa:
+            self._valoraciones = matriz
+            self._ultima_reconstruccion = time.monotonic()
+        self._desde = inicio
+
+    def _calcular(self, matriz, indices):
+        if not indices:
+            return np.array([], dtype=np.int64), []
+        filas, columnas, valores = (np.concatenate(partes) for partes in zip(*indices))
+        columnas = matriz.aplicar_indices(filas, columnas, valores)
+        return columnas, list(vecinos_similares(matriz.matriz, columnas, self.k))
+
+    def _sin_titulo(self, matriz, vecinos):
+        if not vecinos:
+            return []
+        columnas = np.unique(np.concatenate([filas for _, filas, _ in vecinos]))
+        return [matriz.google_ids[columna] for columna in columnas.tolist()
+                if matriz.google_ids[columna] not in self._titulos]
+
+    def _documentos(self, matriz, vecinos):
+        google_ids = matriz.google_ids
+        documentos = {}
+        for columna, filas, similitudes in vecinos:
+            documentos[google_ids[columna]] = [
+                {
+                    "google_id": google_ids[fila],
+                    "titulo": self._titulos.get(google_ids[fila], (None, None))[0],
+                    "autor": self._titulos.get(google_ids[fila], (None, None))[1],
+                    "similitud": round(float(similitud), 4)
+                }
+                for fila, similitud in zip(filas.tolist(), similitudes.tolist())
+            ]
+        return documentos
+
+    async def recomendar(self, user_id, limite=5):
+        # Puntua cada vecino de los libros mejor calificados por el usuario
+        # con similitud x calificacion y descarta los que ya tiene guardados.
+        valorados = await self.repositorio.libros_mejor_calificados(user_id)
+        if not valorados:
+            return []
+        calificaciones = {libro['google_id']: libro['rating'] for libro in valorados}
+        puntuaciones = {}
+        libros = {}
+        for doc in await self.repositorio.vecinos_de(list(calificaciones)):
+            for vecino in doc['vecinos']:
+                puntuaciones[vecino['google_id']] = (
+                    puntuaciones.get(vecino['google_id'], 0) + vecino['similitud'] * calificaciones[doc['_id']]
+                )
+                libros[vecino['google_id']] = vecino
+
+        guardados = await self.repositorio.google_ids_guardados(user_id, list(puntuaciones))
+        candidatos = sorted(
+            (google_id for google_id in puntuaciones if google_id not in guardados),
+            key=puntuaciones.get, reverse=True
+        )
+        return [libros[google_id] for google_id in candidatos[:limite]]
@@ -0,0 +1,550 @@
+import asyncio
+import os
+import re
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from cache import normalizar_consulta
+from metricas import medido
+
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = os.environ.get("MONGO_DB", "biblioteca_db")
+MONGO_POOL = int(os.environ.get("MONGO_POOL", "50"))
+TAMANO_PAGINA = int(os.environ.get("TAMANO_PAGINA", "5"))
+MAX_RESULTADOS_PROPIOS = 50
+
+PROYECCION_BIBLIOTECA = {"google_id": 1, "titulo": 1, "autor": 1, "fecha_agregado": 1, "rating": 1}
+PROYECCION_LISTA = {"google_id": 1, "titulo": 1, "autor": 1, "fecha_agregado": 1}
+
+INDICES = {
+    'usuarios': [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unico")
+    ],
+    'biblioteca_personal': [
+        IndexModel([("user_id", ASCENDING), ("google_id", ASCENDING)], unique=True, name="usuario_libro_unico"),
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="usuario_orden"),
+        IndexModel([("user_id", ASCENDING), ("tokens", ASCENDING)], name="usuario_tokens"),
+        IndexModel([("fecha_calificacion", ASCENDING)], name="fecha_calificacion", sparse=True)
+    ],
+    'lista_lectura': [
+        IndexModel([("user_id", ASCENDING), ("google_id", ASCENDING)], unique=True, name="usuario_libro_unico"),
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="usuario_orden"),
+        IndexModel([("user_id", ASCENDING), ("tokens", ASCENDING)], name="usuario_tokens")
+    ],
+    'estadisticas': [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unico")
+    ],
+    'volumenes': [
+        IndexModel([("isbns", ASCENDING)], name="isbn")
+    ],
+}
+
+
+def clave_genero(genero):
+    # Los nombres de campo de Mongo no admiten '.' ni empezar por '$'
+    return genero.replace('.', '\uff0e').lstrip('$') or 'Otros'
+
+
+def tokens_busqueda(*textos):
+    # Palabras en minusculas y sin tildes de los textos, sin repetir. Se
+    # guardan en cada libro para buscar por prefijo con el indice usuario_tokens.
+    tokens = []
+    for texto in textos:
+        tokens += re.findall(r'\w+', normalizar_consulta(texto or ''))
+    return list(dict.fromkeys(tokens))
+
+
+def con_tokens(libro):
+    libro["tokens"] = tokens_busqueda(libro.get("titulo"), libro.get("autor"))
+    return libro
+
+
+def incrementos_generos(campo, categorias, signo=1):
+    incrementos = {}
+    for genero in categorias or []:
+        clave = f"{campo}.{clave_genero(genero)}"
+        incrementos[clave] = incrementos.get(clave, 0) + signo
+    return incrementos
+
+
+
+class RepositorioMongo:
+    # Acceso asincrono a las colecciones del bot. Se puede pasar un cliente ya
+    # creado (por ejemplo AsyncMongoMockClient de mongomock_motor) para probar
+    # los handlers sin un mongod; en ese caso conviene fijar transacciones=False.
+    def __init__(self, uri=MONGO_URI, nombre_db=MONGO_DB, max_pool=MONGO_POOL, cliente=None,
+                 transacciones=None):
+        self.cliente = cliente or AsyncIOMotorClient(
+            uri,
+            maxPoolSize=max_pool,
+            serverSelectionTimeoutMS=5000
+        )
+        self.db = self.cliente[nombre_db]
+
+        self.usuarios = self.db.usuarios
+        self.biblioteca_personal = self.db.biblioteca_personal
+        self.lista_lectura = self.db.lista_lectura
+        self.volumenes = self.db.volumenes
+        self.portadas = self.db.portadas
+        self.estadisticas = self.db.estadisticas
+        self.recomendaciones = self.db.recomendaciones
+        self.migraciones = self.db.migraciones
+        self.transacciones = transacciones
+
+    def cerrar(self):
+        self.cliente.close()
+
+    @medido('db')
+    async def asegurar_indices(self):
+        # Crea los indices que necesitan las consultas y devuelve los que
+        # existen en cada coleccion para el informe de arranque.
+        informe = {}
+        for nombre, indices in INDICES.items():
+            coleccion = self.db[nombre]
+            try:
+                await coleccion.create_indexes(indices)
+            except OperationFailure as e:
+                print(f"No se pudieron crear los índices de {nombre}: {e}")
+            informe[nombre] = sorted((await coleccion.index_information()).keys())
+        await self._completar_tokens()
+
+        # Las transacciones solo existen en replica sets y clusters
+        if self.transacciones is None:
+            info = await self.db.command('hello')
+            self.transacciones = 'setName' in info or info.get('msg') == 'isdbgrid'
+        return informe
+
+    async def _completar_tokens(self, tamano_lote=500):
+        # Libros guardados antes de que existiera la busqueda en mis libros.
+        # La consulta no tiene indice, asi que se hace una sola vez: al
+        # terminar se anota en 'migraciones' y los siguientes arranques (y
+        # los demas workers) no recorren las colecciones.
+        if await self.migraciones.find_one({"_id": "tokens_busqueda"}):
+            return
+        for coleccion in (self.biblioteca_personal, self.lista_lectura):
+            completados = 0
+            while True:
+                libros = await coleccion.find(
+                    {"tokens": {"$exists": False}}, {"titulo": 1, "autor": 1}
+                ).limit(tamano_lote).to_list(None)
+                if not libros:
+                    break
+                await coleccion.bulk_write([
+                    UpdateOne({"_id": libro["_id"]}, {"$set": {"tokens": con_tokens(libro)["tokens"]}})
+                    for libro in libros
+                ], ordered=False)
+                completados += len(libros)
+            if completados:
+                print(f"Tokens de búsqueda completados en {completados} libros de {coleccion.name}")
+        await self.migraciones.update_one(
+            {"_id": "tokens_busqueda"}, {"$set": {"fecha": datetime.now()}}, upsert=True
+        )
+
+    async def _upsert(self, coleccion, filtro, documento, sesion=None):
+        try:
+            resultado = await coleccion.update_one(
+                filtro, {"$setOnInsert": documento}, upsert=True, session=sesion
+            )
+        except DuplicateKeyError:
+            # Dentro de una transaccion el servidor ya la ha abortado: el
+            # error tiene que llegar a quien la repite
+            if sesion is not None:
+                raise
+            return False
+        return resultado.upserted_id is not None
+
+    async def _pagina(self, coleccion, user_id, proyeccion, despues=None, antes=None, tamano=TAMANO_PAGINA):
+        # Paginacion por rango de _id: cada pagina es una consulta indexada de
+        # tamano + 1 documentos, sin importar cuantos libros tenga el usuario.
+        # Devuelve (libros, hay_pagina_anterior, hay_pagina_siguiente).
+        filtro = {"user_id": user_id}
+        orden = ASCENDING
+        if despues is not None:
+            filtro["_id"] = {"$gt": despues}
+        elif antes is not None:
+            filtro["_id"] = {"$lt": antes}
+            orden = DESCENDING
+
+        libros = await coleccion.find(filtro, proyeccion).sort("_id", orden).limit(tamano + 1).to_list(None)
+        hay_mas = len(libros) > tamano
+        libros = libros[:tamano]
+
+        if antes is not None:
+            libros.reverse()
+            return libros, hay_mas, True
+        return libros, despues is not None, hay_mas
+
+    # Usuarios
+
+    @medido('db')
+    async def registrar_usuarios(self, usuarios):
+        # usuarios: {user_id: username}. Crea los que no existen y actualiza
+        # el username de los demas en un unico bulk_write.
+        ahora = datetime.now()
+        await self.usuarios.bulk_write([
+            UpdateOne(
+                {"user_id": user_id},
+                {"$set": {"username": username}, "$setOnInsert": {"created_at": ahora}},
+                upsert=True
+            )
+            for user_id, username in usuarios.items()
+        ], ordered=False)
+
+    # Biblioteca personal
+
+    @medido('db')
+    async def libros_biblioteca(self, user_id):
+        return await self.biblioteca_personal.find({"user_id": user_id}).to_list(None)
+
+    @medido('db')
+    async def pagina_biblioteca(self, user_id, despues=None, antes=None):
+        return await self._pagina(self.biblioteca_personal, user_id, PROYECCION_BIBLIOTECA, despues, antes)
+
+    @medido('db')
+    async def agregar_a_biblioteca(self, libro):
+        filtro = {"user_id": libro["user_id"], "google_id": libro["google_id"]}
+        insertado = await self._upsert(self.biblioteca_personal, filtro, con_tokens(libro))
+        if insertado:
+            incrementos = {"total_biblioteca": 1}
+            incrementos.update(incrementos_generos("generos_biblioteca", libro.get("categorias")))
+            await self._sumar_estadisticas(libro["user_id"], incrementos)
+        return insertado
+
+    @medido('db')
+    async def eliminar_de_biblioteca(self, user_id, google_id):
+        libro = await self.biblioteca_personal.find_one_and_delete(
+            {"user_id": user_id, "google_id": google_id},
+            projection={"rating": 1, "estado": 1, "categorias": 1}
+        )
+        if not libro:
+            return
+        incrementos = {"total_biblioteca": -1}
+        incrementos.update(incrementos_generos("generos_biblioteca", libro.get("categorias"), -1))
+        if libro.get("estado") == "leído":
+            incrementos["leidos"] = -1
+        if libro.get("rating") is not None:
+            incrementos["suma_rating"] = -libro["rating"]
+            incrementos["num_rating"] = -1
+        await self._sumar_estadisticas(user_id, incrementos)
+
+    @medido('db')
+    async def calificar_varios(self, calificaciones):
+        # calificaciones: {(user_id, google_id): calificacion}. Las notas
+        # anteriores se leen en una sola consulta para sumar a las
+        # estadisticas solo la diferencia; los libros ya borrados se ignoran.
+        filtros = [{"user_id": user_id, "google_id": google_id} for user_id, google_id in calificaciones]
+        anteriores = {}
+        async for libro in self.biblioteca_personal.find({"$or": filtros}, {"user_id": 1, "google_id": 1, "rating": 1}):
+            anteriores[(libro["user_id"], libro["google_id"])] = libro.get("rating")
+
+        ahora = datetime.now()
+        operaciones = []
+        incrementos = {}
+        for (user_id, google_id), calificacion in calificaciones.items():
+            if (user_id, google_id) not in anteriores:
+                continue
+            previa = anteriores[(user_id, google_id)]
+            if previa == calificacion:
+                continue
+            operaciones.append(UpdateOne(
+                {"user_id": user_id, "google_id": google_id},
+                {"$set": {"rating": calificacion, "fecha_calificacion": ahora}}
+            ))
+            suma = incrementos.setdefault(user_id, {"suma_rating": 0, "num_rating": 0})
+            if previa is None:
+                suma["suma_rating"] += calificacion
+                suma["num_rating"] += 1
+            else:
+                suma["suma_rating"] += calificacion - previa
+
+        if operaciones:
+            await self.biblioteca_personal.bulk_write(operaciones, ordered=False)
+            await self.estadisticas.bulk_write([
+                UpdateOne({"user_id": user_id}, {"$inc": suma}) for user_id, suma in incrementos.items()
+            ], ordered=False)
+
+    # Lista de lectura
+
+    @medido('db')
+    async def pagina_lista(self, user_id, despues=None, antes=None):
+        return await self._pagina(self.lista_lectura, user_id, PROYECCION_LISTA, despues, antes)
+
+    @medido('db')
+    async def agregar_a_lista(self, libro):
+        filtro = {"user_id": libro["user_id"], "google_id": libro["google_id"]}
+        insertado = await self._upsert(self.lista_lectura, filtro, con_tokens(libro))
+        if insertado:
+            incrementos = {"total_lista": 1}
+            incrementos.update(incrementos_generos("generos_lista", libro.get("categorias")))
+            await self._sumar_estadisticas(libro["user_id"], incrementos)
+        return insertado
+
+    @medido('db')
+    async def eliminar_de_lista(self, user_id, google_id):
+        libro = await self.lista_lectura.find_one_and_delete(
+            {"user_id": user_id, "google_id": google_id},
+            projection={"categorias": 1}
+        )
+        if not libro:
+            return
+        incrementos = {"total_lista": -1}
+        incrementos.update(incrementos_generos("generos_lista", libro.get("categorias"), -1))
+        await self._sumar_estadisticas(user_id, incrementos)
+
+    @medido('db')
+    async def marcar_como_leido(self, user_id, google_id):
+        if not self.transacciones:
+            return await self._mover_a_biblioteca(user_id, google_id)
+
+        # with_transaction repite la transaccion ante errores transitorios
+        # (conflictos de escritura, elecciones de primario) y el commit ante
+        # un resultado desconocido
+        async def mover(sesion):
+            return await self._mover_a_biblioteca(user_id, google_id, sesion)
+
+        async with await self.cliente.start_session() as sesion:
+            try:
+                return await sesion.with_transaction(mover)
+            except DuplicateKeyError:
+                # Otro movimiento del mismo libro confirmo el suyo entre la
+                # lectura y el upsert: al repetir, el upsert ya lo encuentra
+                return await sesion.with_transaction(mover)
+
+    async def _mover_a_biblioteca(self, user_id, google_id, sesion=None):
+        # Sin transaccion el orden (upsert y luego borrado) hace que repetir el
+        # movimiento sea inofensivo: solo quien borra de la lista lo completa.
+        filtro = {"user_id": user_id, "google_id": google_id}
+        libro = await self.lista_lectura.find_one(filtro, session=sesion)
+        if not libro:
+            return None
+
+        libro.pop("_id")
+        libro["estado"] = "leído"
+        libro["fecha_leido"] = datetime.now()
+        insertado = await self._upsert(self.biblioteca_personal, filtro, libro, sesion)
+        if insertado:
+            incrementos = {"total_biblioteca": 1, "leidos": 1}
+            incrementos.update(incrementos_generos("generos_biblioteca", libro.get("categorias")))
+            await self._sumar_estadisticas(user_id, incrementos, sesion)
+
+        resultado = await self.lista_lectura.delete_one(filtro, session=sesion)
+        if resultado.deleted_count == 0:
+            return None
+        incrementos = {"total_lista": -1}
+        incrementos.update(incrementos_generos("generos_lista", libro.get("categorias"), -1))
+        await self._sumar_estadisticas(user_id, incrementos, sesion)
+        return libro
+
+    # Busqueda en mis libros
+
+    @medido('db')
+    async def buscar_libros_propios(self, user_id, texto, limite=MAX_RESULTADOS_PROPIOS):
+        # Cada palabra buscada debe ser prefijo de alguna palabra del titulo o
+        # del autor. Las regex ancladas (^...) sobre 'tokens' se resuelven como
+        # rangos del indice usuario_tokens, sin recorrer la coleccion.
+        terminos = tokens_busqueda(texto)
+        if not terminos:
+            return []
+        filtro = {"user_id": user_id, "$and": [{"tokens": {"$regex": f"^{re.escape(termino)}"}} for termino in terminos]}
+
+        async def buscar(coleccion, proyeccion, estante):
+            libros = await coleccion.find(filtro, proyeccion).sort("_id", ASCENDING).limit(limite).to_list(None)
+            return [dict(libro, estante=estante) for libro in libros]
+
+        biblioteca, lista = await asyncio.gather(
+            buscar(self.biblioteca_personal, PROYECCION_BIBLIOTECA, 'biblioteca'),
+            buscar(self.lista_lectura, PROYECCION_LISTA, 'lista')
+        )
+        return biblioteca + lista
+
+    # Recomendaciones
+
+    async def valoraciones(self, desde=None, tamano_lote=10000):
+        # Calificaciones de todos los usuarios, en lotes de tuplas
+        # (user_id, google_id, rating); con 'desde', solo las posteriores
+        # (indice fecha_calificacion).
+        filtro = {"rating": {"$exists": True}}
+        if desde is not None:
+            filtro = {"fecha_calificacion": {"$gte": desde}}
+        cursor = self.biblioteca_personal.find(
+            filtro, {"_id": 0, "user_id": 1, "google_id": 1, "rating": 1}, batch_size=tamano_lote
+        )
+        lote = []
+        async for doc in cursor:
+            lote.append((doc["user_id"], doc["google_id"], doc["rating"]))
+            if len(lote) == tamano_lote:
+                yield lote
+                lote = []
+        if lote:
+            yield lote
+
+    async def titulos(self, google_ids, tamano_lote=1000):
+        # {google_id: (titulo, autor)} de la cache de volumenes. Los que no
+        # esten ahi se buscan en las bibliotecas con una sola agregacion.
+        titulos = {}
+        for inicio in range(0, len(google_ids), tamano_lote):
+            lote = google_ids[inicio:inicio + tamano_lote]
+            async for doc in self.volumenes.find(
+                {"_id": {"$in": lote}}, {"volumeInfo.title": 1, "volumeInfo.authors": 1}
+            ):
+                info = doc.get("volumeInfo", {})
+                titulos[doc["_id"]] = (info.get("title"), ', '.join(info.get("authors", [])) or None)
+        faltan = [google_id for google_id in google_ids if google_id not in titulos]
+        if faltan:
+            async for doc in self.biblioteca_personal.aggregate([
+                {"$match": {"google_id": {"$in": faltan}}},
+                {"$group": {"_id": "$google_id", "titulo": {"$first": "$titulo"}, "autor": {"$first": "$autor"}}}
+            ]):
+                titulos[doc["_id"]] = (doc.get("titulo"), doc.get("autor"))
+        return titulos
+
+    async def guardar_recomendaciones(self, vecinos, tamano_lote=1000):
+        # vecinos: {google_id: [{google_id, titulo, autor, similitud}, ...]}
+        ahora = datetime.now()
+        operaciones = [
+            ReplaceOne({"_id": google_id}, {"vecinos": lista, "actualizado": ahora}, upsert=True)
+            for google_id, lista in vecinos.items()
+        ]
+        for inicio in range(0, len(operaciones), tamano_lote):
+            await self.recomendaciones.bulk_write(operaciones[inicio:inicio + tamano_lote], ordered=False)
+
+    @medido('db')
+    async def libros_mejor_calificados(self, user_id, minimo=6, limite=20):
+        return await self.biblioteca_personal.find(
+            {"user_id": user_id, "rating": {"$gte": minimo}}, {"google_id": 1, "rating": 1}
+        ).sort("rating", DESCENDING).limit(limite).to_list(None)
+
+    @medido('db')
+    async def vecinos_de(self, google_ids):
+        return await self.recomendaciones.find({"_id": {"$in": google_ids}}).to_list(None)
+
+    @medido('db')
+    async def google_ids_guardados(self, user_id, google_ids):
+        filtro = {"user_id": user_id, "google_id": {"$in": google_ids}}
+        biblioteca, lista = await asyncio.gather(
+            self.biblioteca_personal.distinct("google_id", filtro),
+            self.lista_lectura.distinct("google_id", filtro)
+        )
+        return set(biblioteca) | set(lista)
+
+    # Importacion y exportacion
+
+    @medido('db')
+    async def importar_libros(self, coleccion, libros):
+        # Un unico bulk_write por lote; los libros que el usuario ya tenia no se
+        # tocan. Las estadisticas no se actualizan aqui: al terminar la
+        # importacion se recalculan con reconstruir_estadisticas.
+        if not libros:
+            return 0
+        operaciones = [
+            UpdateOne({"user_id": libro["user_id"], "google_id": libro["google_id"]},
+                      {"$setOnInsert": con_tokens(libro)}, upsert=True)
+            for libro in libros
+        ]
+        try:
+            resultado = await self.db[coleccion].bulk_write(operaciones, ordered=False)
+        except BulkWriteError as e:
+            # Duplicados por una insercion concurrente del mismo libro
+            return e.details.get("nUpserted", 0)
+        return resultado.upserted_count
+
+    async def iterar_libros(self, user_id, tamano_lote=200):
+        # Recorre biblioteca y lista con cursores por lotes, sin cargarlas
+        # enteras en memoria. Cada libro trae los ISBN de la cache de volumenes.
+        for estante, coleccion in (('biblioteca', self.biblioteca_personal), ('lista', self.lista_lectura)):
+            cursor = coleccion.aggregate([
+                {"$match": {"user_id": user_id}},
+                {"$sort": {"_id": ASCENDING}},
+                {"$lookup": {"from": self.volumenes.name, "localField": "google_id",
+                             "foreignField": "_id", "as": "volumen"}},
+                {"$project": {"_id": 0, "google_id": 1, "titulo": 1, "autor": 1, "rating": 1,
+                              "estado": 1, "fecha_agregado": 1, "isbns": "$volumen.isbns"}}
+            ], batchSize=tamano_lote)
+            async for libro in cursor:
+                yield estante, libro
+
+    # Estadisticas
+
+    async def _sumar_estadisticas(self, user_id, incrementos, sesion=None):
+        # Sin upsert: si el usuario aun no tiene documento de estadisticas se
+        # creara completo con reconstruir_estadisticas la primera vez que las vea.
+        await self.estadisticas.update_one({"user_id": user_id}, {"$inc": incrementos}, session=sesion)
+
+    @medido('db')
+    async def obtener_estadisticas(self, user_id):
+        return await self.estadisticas.find_one({"user_id": user_id})
+
+    @medido('db')
+    async def reconstruir_estadisticas(self, user_id):
+        # Recalcula el documento con agregaciones. Antes completa las
+        # categorias de los libros guardados sin ellas a partir de la cache de
+        # volumenes. Devuelve el documento nuevo y los campos en los que difiere
+        # del que se mantenia de forma incremental (None si no existia).
+        for coleccion in (self.biblioteca_personal, self.lista_lectura):
+            sin_categorias = await coleccion.aggregate([
+                {"$match": {"user_id": user_id, "categorias": {"$exists": False}}},
+                {"$lookup": {"from": self.volumenes.name, "localField": "google_id",
+                             "foreignField": "_id", "as": "volumen"}},
+                {"$project": {"categorias": {"$ifNull": [
+                    {"$arrayElemAt": ["$volumen.volumeInfo.categories", 0]}, []
+                ]}}}
+            ]).to_list(None)
+            if sin_categorias:
+                await coleccion.bulk_write([
+                    UpdateOne({"_id": libro["_id"]}, {"$set": {"categorias": libro["categorias"]}})
+                    for libro in sin_categorias
+                ], ordered=False)
+
+        biblioteca = await self._agregar_coleccion(self.biblioteca_personal, user_id, {
+            "total": {"$sum": 1},
+            "leidos": {"$sum": {"$cond": [{"$eq": ["$estado", "leído"]}, 1, 0]}},
+            "suma_rating": {"$sum": {"$ifNull": ["$rating", 0]}},
+            "num_rating": {"$sum": {"$cond": [{"$gt": ["$rating", None]}, 1, 0]}}
+        })
+        lista = await self._agregar_coleccion(self.lista_lectura, user_id, {"total": {"$sum": 1}})
+
+        nuevo = {
+            "user_id": user_id,
+            "total_biblioteca": biblioteca["totales"].get("total", 0),
+            "leidos": biblioteca["totales"].get("leidos", 0),
+            "suma_rating": biblioteca["totales"].get("suma_rating", 0),
+            "num_rating": biblioteca["totales"].get("num_rating", 0),
+            "generos_biblioteca": biblioteca["generos"],
+            "total_lista": lista["totales"].get("total", 0),
+            "generos_lista": lista["generos"]
+        }
+        anterior = await self.estadisticas.find_one_and_replace(
+            {"user_id": user_id}, nuevo, projection={"_id": 0}, upsert=True
+        )
+        if anterior is None:
+            return nuevo, None
+        diferencias = []
+        for campo, valor in nuevo.items():
+            previo = anterior.get(campo, 0)
+            if isinstance(valor, dict):
+                previo = {clave: cantidad for clave, cantidad in (previo or {}).items() if cantidad}
+            if previo != valor:
+                diferencias.append(campo)
+        return nuevo, diferencias
+
+    async def _agregar_coleccion(self, coleccion, user_id, acumuladores):
+        resultado = await coleccion.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$facet": {
+                "totales": [{"$group": {"_id": None, **acumuladores}}],
+                "generos": [
+                    {"$unwind": "$categorias"},
+                    {"$group": {"_id": "$categorias", "cantidad": {"$sum": 1}}}
+                ]
+            }}
+        ]).to_list(None)
+        totales = resultado[0]["totales"][0] if resultado[0]["totales"] else {}
+        generos = {}
+        for genero in resultado[0]["generos"]:
+            clave = clave_genero(genero["_id"])
+            generos[clave] = generos.get(clave, 0) + genero["cantidad"]
+        return {"totales": totales, "generos": generos}
@@ -0,0 +1,61 @@
+import asyncio
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+
+class Peticion:
+    def __init__(self, metodo, ruta, consulta, cabeceras, cuerpo):
+        self.metodo = metodo
+        self.ruta = ruta
+        self.consulta = consulta
+        self.cabeceras = cabeceras
+        self.cuerpo = cuerpo
+
+
+async def servir(manejador, host='127.0.0.1', puerto=8080):
+    # Servidor HTTP/1.1 minimo (con keep-alive) sobre asyncio. El manejador
+    # recibe una Peticion y devuelve (estado, tipo_contenido, cuerpo_bytes).
+    async def atender(lector, escritor):
+        try:
+            while True:
+                linea = await lector.readline()
+                if not linea:
+                    break
+                metodo, objetivo, _ = linea.decode('latin-1').split(' ', 2)
+
+                cabeceras = {}
+                while True:
+                    linea = await lector.readline()
+                    if linea in (b'\r\n', b'\n', b''):
+                        break
+                    nombre, _, valor = linea.decode('latin-1').partition(':')
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+
+                longitud = int(cabeceras.get('content-length', 0))
+                cuerpo = await lector.readexactly(longitud) if longitud else b''
+
+                url = urlsplit(objetivo)
+                peticion = Peticion(metodo, url.path, parse_qs(url.query), cabeceras, cuerpo)
+                try:
+                    estado, tipo, respuesta = await manejador(peticion)
+                except Exception as e:
+                    print(f"Error atendiendo {metodo} {url.path}: {e}")
+                    estado, tipo, respuesta = 500, 'text/plain', b'error'
+
+                mantener = cabeceras.get('connection', '').lower() != 'close'
+                escritor.write(
+                    f"HTTP/1.1 {estado} {HTTPStatus(estado).phrase}\r\n"
+                    f"Content-Type: {tipo}\r\n"
+                    f"Content-Length: {len(respuesta)}\r\n"
+                    f"Connection: {'keep-alive' if mantener else 'close'}\r\n\r\n".encode('latin-1')
+                    + respuesta
+                )
+                await escritor.drain()
+                if not mantener:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            escritor.close()
+
+    return await asyncio.start_server(atender, host, puerto)
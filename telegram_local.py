@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import time
+
+from telegram.request import BaseRequest
+
+
+class PeticionLocal(BaseRequest):
+    # Sustituto de la Bot API de Telegram para probar el bot sin red: responde
+    # a cada metodo con un resultado minimo valido en lugar de hacer la peticion.
+    # 'latencia' (segundos) simula el tiempo de ida y vuelta de la API real.
+    def __init__(self, registrar=False, latencia=0.0):
+        self.registrar = registrar
+        self.latencia = latencia
+        self._mensajes = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        metodo = url.rsplit('/', 1)[-1]
+        parametros = request_data.parameters if request_data else {}
+        if self.registrar:
+            print(f"→ {metodo} {json.dumps(parametros, ensure_ascii=False, default=str)[:300]}")
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        resultado = self.responder(metodo, parametros)
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+    def responder(self, metodo, parametros):
+        if metodo == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "CapituloCeroBot",
+                    "username": "CapituloCeroBot", "can_join_groups": False,
+                    "can_read_all_group_messages": False, "supports_inline_queries": True}
+        if metodo in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument'):
+            return self._mensaje(parametros, texto=parametros.get('text'))
+        if metodo == 'sendPhoto':
+            return self._mensaje(parametros, foto=parametros.get('photo'))
+        if metodo == 'sendMediaGroup':
+            return [self._mensaje(parametros, foto=media.get('media')) for media in parametros.get('media', [])]
+        return True
+
+    def _mensaje(self, parametros, texto=None, foto=None):
+        chat_id = parametros.get('chat_id', 0)
+        mensaje = {
+            "message_id": parametros.get('message_id') or next(self._mensajes),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "group"},
+        }
+        if texto is not None:
+            mensaje["text"] = texto
+        if foto is not None:
+            file_id = "local_" + hashlib.sha1(str(foto).encode()).hexdigest()[:20]
+            mensaje["photo"] = [{"file_id": file_id, "file_unique_id": file_id[-10:],
+                                 "width": 128, "height": 192}]
+        return mensaje
@@ -0,0 +1,77 @@
+import asyncio
+
+
+class VolcadoDiferido:
+    # Cambios pendientes de escribir en Mongo, agrupados por tipo y clave (el
+    # ultimo gana). Se vuelcan todos juntos con escribir({tipo: {clave: valor}})
+    # como mucho 'intervalo' segundos despues del primer cambio, antes si se
+    # llega a 'max_pendientes' o se llama a vaciar().
+    #
+    # Si la escritura falla los cambios vuelven a 'pendientes' sin pisar otros
+    # mas nuevos y se reintentan en el siguiente vaciado.
+    def __init__(self, escribir, tipos, intervalo, max_pendientes=None, descripcion="la escritura diferida"):
+        self.escribir = escribir
+        self.intervalo = intervalo
+        self.max_pendientes = max_pendientes
+        self.descripcion = descripcion
+        self.pendientes = {tipo: {} for tipo in tipos}
+        self._vaciado = None
+        self._lleno = asyncio.Event()
+        self._cerrojo = asyncio.Lock()
+
+    def __len__(self):
+        return sum(len(cambios) for cambios in self.pendientes.values())
+
+    @property
+    def escribiendo(self):
+        # Hay un vaciado en curso: sus cambios ya no estan en 'pendientes'
+        # pero todavia no se han escrito
+        return self._cerrojo.locked()
+
+    def anotar(self, tipo, clave, valor):
+        self.pendientes[tipo][clave] = valor
+        if self.max_pendientes and len(self) >= self.max_pendientes:
+            self._lleno.set()
+        self._programar()
+
+    def _programar(self):
+        if self._vaciado is None:
+            self._vaciado = asyncio.create_task(self._vaciar_tras_intervalo())
+
+    async def _vaciar_tras_intervalo(self):
+        try:
+            await asyncio.wait_for(self._lleno.wait(), self.intervalo)
+        except asyncio.TimeoutError:
+            pass
+        self._lleno.clear()
+        self._vaciado = None
+        await self.vaciar()
+
+    async def vaciar(self, filtro=None):
+        # filtro(tipo, clave) limita el vaciado a esas claves. Siempre espera
+        # a que termine el vaciado en curso, que puede incluirlas.
+        async with self._cerrojo:
+            cambios = {}
+            for tipo, pendientes in self.pendientes.items():
+                if filtro is None:
+                    cambios[tipo], self.pendientes[tipo] = pendientes, {}
+                else:
+                    claves = [clave for clave in pendientes if filtro(tipo, clave)]
+                    cambios[tipo] = {clave: pendientes.pop(clave) for clave in claves}
+            if not any(cambios.values()):
+                return
+
+            try:
+                await self.escribir(cambios)
+            except Exception as e:
+                print(f"Error en {self.descripcion}: {e}")
+                for tipo, valores in cambios.items():
+                    for clave, valor in valores.items():
+                        self.pendientes[tipo].setdefault(clave, valor)
+                self._programar()
+
+    async def cerrar(self):
+        if self._vaciado is not None:
+            self._vaciado.cancel()
+            self._vaciado = None
+        await self.vaciar()
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import multiprocessing
+import signal
+
+from telegram import Bot, Update
+
+from CapituloCeroBot import CapituloCeroBot, crear_aplicacion
+from google_books import GOOGLE_CUOTA_MINUTO, ClienteGoogleBooks
+from servidor_http import servir
+from telegram_local import PeticionLocal
+
+
+def usuario_de_update(datos):
+    # Todos los tipos de update llevan el usuario en 'from' (o 'user' en
+    # poll_answer y similares); si no, se usa el chat.
+    for valor in datos.values():
+        if not isinstance(valor, dict):
+            continue
+        usuario = valor.get('from') or valor.get('user')
+        if usuario:
+            return usuario['id']
+        chat = valor.get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+def _trabajador(indice, workers, cola, token, sin_telegram):
+    # Ctrl-C y el SIGTERM de systemd llegan a todo el grupo de procesos. Los
+    # workers los ignoran y terminan cuando el frontal les envia None, despues
+    # de volcar las escrituras pendientes.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_ejecutar_trabajador(indice, workers, cola, token, sin_telegram))
+
+
+async def _ejecutar_trabajador(indice, workers, cola, token, sin_telegram):
+    # Cada worker es una Application completa sin Updater: recibe los updates
+    # ya decodificados por la cola y los procesa en paralelo entre usuarios y
+    # en orden de llegada para cada usuario.
+    request = PeticionLocal(registrar=True) if sin_telegram else None
+    # La cuota de Google es por proceso: se reparte entre los workers
+    bot = CapituloCeroBot(token, google_books=ClienteGoogleBooks(cuota_minuto=GOOGLE_CUOTA_MINUTO / workers))
+    if bot.metricas.puerto:
+        # Cada worker expone sus metricas en un puerto consecutivo
+        bot.metricas.puerto += indice
+    # Las recomendaciones se calculan en un solo worker; todos las consultan
+    bot.recomendador.activo = bot.recomendador.activo and indice == 0
+    application = crear_aplicacion(token, bot=bot, request=request, con_updater=False)
+    loop = asyncio.get_running_loop()
+
+    try:
+        async with application:
+            try:
+                if application.post_init:
+                    await application.post_init(application)
+                await application.start()
+                print(f"Worker {indice} listo")
+
+                while True:
+                    # Si el procesador esta lleno los updates esperan en la cola del proceso frontal
+                    await application.update_processor.esperar_capacidad()
+                    datos = await loop.run_in_executor(None, cola.get)
+                    if datos is None:
+                        break
+                    await application.update_queue.put(Update.de_json(datos, application.bot))
+            finally:
+                if application.running:
+                    await application.stop()
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def servir_webhook(token, workers=4, host='127.0.0.1', puerto=8443, ruta='/webhook',
+                         url_publica=None, secreto=None, sin_telegram=False):
+    # Un proceso frontal recibe los updates por HTTP y los reparte entre los
+    # workers por user_id, de modo que los de un mismo usuario siempre van al
+    # mismo worker y se procesan en orden.
+    contexto = multiprocessing.get_context('spawn')
+    colas = [contexto.Queue() for _ in range(workers)]
+    procesos = [
+        contexto.Process(target=_trabajador, args=(indice, workers, colas[indice], token, sin_telegram), daemon=True)
+        for indice in range(workers)
+    ]
+    for proceso in procesos:
+        proceso.start()
+
+    async def recibir_update(peticion):
+        if peticion.metodo != 'POST' or peticion.ruta != ruta:
+            return 404, 'text/plain', b'no encontrado'
+        if secreto and peticion.cabeceras.get('x-telegram-bot-api-secret-token') != secreto:
+            return 403, 'text/plain', b'prohibido'
+        try:
+            datos = json.loads(peticion.cuerpo)
+        except ValueError:
+            return 400, 'text/plain', b'json no valido'
+
+        colas[usuario_de_update(datos) % workers].put(datos)
+        return 200, 'application/json', b'{}'
+
+    servidor = await servir(recibir_update, host, puerto)
+    print(f"Webhook escuchando en http://{host}:{puerto}{ruta}")
+
+    if url_publica and not sin_telegram:
+        async with Bot(token) as bot:
+            await bot.set_webhook(url_publica, secret_token=secreto, allowed_updates=Update.ALL_TYPES)
+
+    parada = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(senal, parada.set)
+    await parada.wait()
+
+    print("Deteniendo webhook...")
+    servidor.close()
+    await servidor.wait_closed()
+    for cola in colas:
+        cola.put(None)
+    for proceso in procesos:
+        await loop.run_in_executor(None, proceso.join, 30)